@@ -0,0 +1,12 @@
+import numpy
+
+
+__author__ = 'Jacob'
+
+
+def expand_ranges(starts, ends):
+    # For ranges [start, end), returns which range each element came from and the element itself.
+    counts = ends - starts
+    range_numbers = numpy.repeat(numpy.arange(len(starts)), counts)
+    offsets_within_ranges = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return range_numbers, starts[range_numbers] + offsets_within_ranges
@@ -0,0 +1,186 @@
+import numpy
+
+from array_helpers import expand_ranges
+
+
+__author__ = 'Jacob'
+
+
+def spread_bits(integers):
+    # Puts two zero bits between each of the lowest 21 bits, so three spread coordinates can be interleaved.
+    integers = integers.astype(numpy.int64) & 0x1fffff
+    integers = (integers | integers << 32) & 0x1f00000000ffff
+    integers = (integers | integers << 16) & 0x1f0000ff0000ff
+    integers = (integers | integers << 8) & 0x100f00f00f00f00f
+    integers = (integers | integers << 4) & 0x10c30c30c30c30c3
+    integers = (integers | integers << 2) & 0x1249249249249249
+    return integers
+
+
+def reduce_over_ranges(reduction, values, starts, ends):
+    # reduction.reduceat over the ranges [start, end), which may have gaps between them. The ranges can't be empty.
+    padded_values = numpy.concatenate([values, numpy.zeros((1,) + values.shape[1:])])
+    boundaries = numpy.empty(2 * len(starts), dtype=numpy.int64)
+    boundaries[0::2] = starts
+    boundaries[1::2] = ends
+    return reduction.reduceat(padded_values, boundaries, axis=0)[0::2]
+
+
+def sum_over_ranges(values, starts, ends):
+    return reduce_over_ranges(numpy.add, values, starts, ends)
+
+
+class MortonOrderedTree(object):
+    # An octree over a set of points, built by sorting the bodies along a Morton (z-order) curve so every node is a
+    # contiguous range of the sorted bodies. Nodes are stored level by level in flat arrays.
+    # The arrays a built tree is made of, see from_arrays().
+    array_names = ('sorted_order', 'sorted_position_of_body', 'sorted_positions', 'node_starts', 'node_ends',
+                   'node_first_children', 'node_child_counts', 'node_sizes', 'node_is_leaf')
+
+    def __init__(self, positions, leaf_size=8, maximum_depth=16):
+        number_of_bodies = len(positions)
+        self.leaf_size = leaf_size
+
+        lower_corner = positions.min(axis=0)
+        root_size = max(numpy.max(positions.max(axis=0) - lower_corner), 1e-9) * (1. + 1e-9)
+        cells_per_side = 2**maximum_depth
+        cells = numpy.floor((positions - lower_corner) / root_size * cells_per_side)
+        cells = numpy.clip(cells, 0, cells_per_side - 1).astype(numpy.int64)
+        keys = spread_bits(cells[:, 0]) | (spread_bits(cells[:, 1]) << 1) | (spread_bits(cells[:, 2]) << 2)
+
+        self.sorted_order = numpy.argsort(keys, kind='mergesort')
+        self.sorted_position_of_body = numpy.empty(number_of_bodies, dtype=numpy.int64)
+        self.sorted_position_of_body[self.sorted_order] = numpy.arange(number_of_bodies)
+        keys = keys[self.sorted_order]
+        self.sorted_positions = positions[self.sorted_order]
+
+        level_starts = [numpy.array([0])]
+        level_ends = [numpy.array([number_of_bodies])]
+        level_first_children = []
+        level_child_counts = []
+        level_sizes = [root_size]
+        prefixes = numpy.array([0], dtype=numpy.int64)
+        number_of_nodes = 1
+
+        for level in xrange(1, maximum_depth + 1):
+            starts, ends = level_starts[-1], level_ends[-1]
+            opened = (ends - starts) > leaf_size
+            first_children = numpy.zeros(len(starts), dtype=numpy.int64)
+            child_counts = numpy.zeros(len(starts), dtype=numpy.int64)
+            level_first_children.append(first_children)
+            level_child_counts.append(child_counts)
+            if not opened.any():
+                break
+
+            bodies = expand_ranges(starts[opened], ends[opened])[1]
+            child_prefixes = keys[bodies] >> (3 * (maximum_depth - level))
+            first_in_child = numpy.flatnonzero(numpy.concatenate([[True], child_prefixes[1:] != child_prefixes[:-1]]))
+            last_in_child = numpy.concatenate([first_in_child[1:], [len(bodies)]]) - 1
+            child_prefixes = child_prefixes[first_in_child]
+
+            # The children come out in the same order as their parents, so each parent's children are contiguous.
+            parents = numpy.searchsorted(prefixes, child_prefixes >> 3)
+            child_counts[:] = numpy.bincount(parents, minlength=len(starts))
+            first_children[:] = number_of_nodes + numpy.cumsum(child_counts) - child_counts
+
+            level_starts.append(bodies[first_in_child])
+            level_ends.append(bodies[last_in_child] + 1)
+            level_sizes.append(root_size / 2.**level)
+            prefixes = child_prefixes
+            number_of_nodes += len(child_prefixes)
+        else:
+            level_first_children.append(numpy.zeros(len(level_starts[-1]), dtype=numpy.int64))
+            level_child_counts.append(numpy.zeros(len(level_starts[-1]), dtype=numpy.int64))
+
+        self.node_starts = numpy.concatenate(level_starts)
+        self.node_ends = numpy.concatenate(level_ends)
+        self.node_first_children = numpy.concatenate(level_first_children)
+        self.node_child_counts = numpy.concatenate(level_child_counts)
+        self.node_sizes = numpy.concatenate([numpy.full(len(starts), size)
+                                             for starts, size in zip(level_starts, level_sizes)])
+        self.node_is_leaf = self.node_child_counts == 0
+
+    @classmethod
+    def from_arrays(cls, tree_arrays):
+        # A tree made of the arrays of one that was already built (copies of them in shared memory, say), by name,
+        # without building it again.
+        tree = cls.__new__(cls)
+        for array_name in cls.array_names:
+            setattr(tree, array_name, tree_arrays[array_name])
+        return tree
+
+
+class BarnesHutOctree(MortonOrderedTree):
+    # A MortonOrderedTree over point masses, with each node's total mass and center of mass.
+    array_names = MortonOrderedTree.array_names + ('sorted_masses', 'node_masses', 'node_centers_of_mass')
+
+    def __init__(self, positions, masses, leaf_size=8, maximum_depth=16):
+        MortonOrderedTree.__init__(self, positions, leaf_size, maximum_depth)
+        self.sorted_masses = masses[self.sorted_order]
+
+        self.node_masses = sum_over_ranges(self.sorted_masses, self.node_starts, self.node_ends)
+        weighted_positions = sum_over_ranges(self.sorted_positions * self.sorted_masses[:, numpy.newaxis],
+                                             self.node_starts, self.node_ends)
+        has_mass = self.node_masses > 0.
+        self.node_centers_of_mass = self.sorted_positions[self.node_starts].copy()
+        self.node_centers_of_mass[has_mass] = weighted_positions[has_mass] / self.node_masses[has_mass, numpy.newaxis]
+
+    def calculate_accelerations(self, target_positions, target_bodies=None, opening_angle=.5,
+                                softening_length=0., targets_per_chunk=1024):
+        # Walks the tree for all the targets at once. A node far enough away (size / distance < opening_angle) is
+        # treated as a point mass, a close leaf is summed body by body, and anything else is opened up.
+        # target_bodies gives each target's index among the bodies the tree was built from, so a body never pulls on
+        # itself and is never lumped in with a node it is inside of.
+        accelerations = numpy.zeros((len(target_positions), 3))
+        opening_angle_squared = opening_angle * opening_angle
+        softening_squared = softening_length * softening_length
+
+        for target_start in xrange(0, len(target_positions), targets_per_chunk):
+            chunk_positions = target_positions[target_start:target_start + targets_per_chunk]
+            number_in_chunk = len(chunk_positions)
+            if target_bodies is None:
+                chunk_sorted_bodies = numpy.full(number_in_chunk, -1, dtype=numpy.int64)
+            else:
+                chunk_sorted_bodies = self.sorted_position_of_body[target_bodies[target_start:target_start + targets_per_chunk]]
+            chunk_accelerations = accelerations[target_start:target_start + targets_per_chunk]
+
+            targets = numpy.arange(number_in_chunk)
+            nodes = numpy.zeros(number_in_chunk, dtype=numpy.int64)
+
+            while len(targets):
+                distance_vectors = self.node_centers_of_mass[nodes] - chunk_positions[targets]
+                distances_squared = numpy.sum(distance_vectors * distance_vectors, axis=1)
+                sorted_bodies = chunk_sorted_bodies[targets]
+                inside_node = (self.node_starts[nodes] <= sorted_bodies) & (sorted_bodies < self.node_ends[nodes])
+                sizes = self.node_sizes[nodes]
+                far_enough = (sizes * sizes < opening_angle_squared * distances_squared) & ~inside_node
+
+                self.add_pulls(chunk_accelerations, targets[far_enough], distance_vectors[far_enough],
+                               distances_squared[far_enough], self.node_masses[nodes[far_enough]], softening_squared)
+
+                close_leaves = ~far_enough & self.node_is_leaf[nodes]
+                leaf_pairs, bodies = expand_ranges(self.node_starts[nodes[close_leaves]], self.node_ends[nodes[close_leaves]])
+                leaf_targets = targets[close_leaves][leaf_pairs]
+                not_itself = bodies != chunk_sorted_bodies[leaf_targets]
+                leaf_targets, bodies = leaf_targets[not_itself], bodies[not_itself]
+                body_distance_vectors = self.sorted_positions[bodies] - chunk_positions[leaf_targets]
+                self.add_pulls(chunk_accelerations, leaf_targets, body_distance_vectors,
+                               numpy.sum(body_distance_vectors * body_distance_vectors, axis=1),
+                               self.sorted_masses[bodies], softening_squared)
+
+                opened = ~far_enough & ~self.node_is_leaf[nodes]
+                child_pairs, nodes = expand_ranges(self.node_first_children[nodes[opened]],
+                                                   self.node_first_children[nodes[opened]] + self.node_child_counts[nodes[opened]])
+                targets = targets[opened][child_pairs]
+
+        return accelerations
+
+    @staticmethod
+    def add_pulls(accelerations, targets, distance_vectors, distances_squared, masses, softening_squared):
+        softened_distances_squared = distances_squared + softening_squared
+        # Two bodies in the exact same spot with no softening can't pull on each other in any direction.
+        softened_distances_squared[softened_distances_squared == 0.] = numpy.inf
+        pulls = (masses / (softened_distances_squared * numpy.sqrt(softened_distances_squared)))[:, numpy.newaxis] * distance_vectors
+        for dimension_index in xrange(3):
+            accelerations[:, dimension_index] += numpy.bincount(targets, weights=pulls[:, dimension_index],
+                                                                minlength=len(accelerations))
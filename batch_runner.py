@@ -0,0 +1,74 @@
+import multiprocessing
+import time
+
+import numpy
+
+from scenarios import create_world, scenarios
+
+
+__author__ = 'Jacob'
+
+
+def run_world(scenario_name, seed, steps, world_options=None):
+    # Builds one seeded world, runs it for the given number of steps, and sums up how it went.
+    world = create_world(scenario_name, seed, **(world_options or {}))
+    arrays = world.space_object_arrays
+    detector = world.collision_detector_and_resolver
+    contacts = 0
+    most_contacts = 0
+
+    start_time = time.time()
+    for step in xrange(steps):
+        world.go_forward_one_time_step()
+        contacts += detector.step_report['colliding_pairs']
+        most_contacts = max(most_contacts, detector.step_report['colliding_pairs'])
+    elapsed_time = time.time() - start_time
+
+    number_of_objects = arrays.number_of_objects
+    movable = arrays.indices_of('movable')
+    velocities = arrays.velocities[movable]
+    return {'scenario': scenario_name,
+            'seed': seed,
+            'steps': steps,
+            'objects': number_of_objects,
+            'elapsed_time': elapsed_time,
+            'steps_per_second': steps / elapsed_time if elapsed_time > 0. else float('inf'),
+            'kinetic_energy': float(.5 * numpy.sum(arrays.masses[movable] * numpy.sum(velocities * velocities, axis=1))),
+            'contacts': contacts,
+            'most_contacts_in_a_step': most_contacts,
+            'positions': arrays.positions[:number_of_objects].tolist(),
+            'velocities': arrays.velocities[:number_of_objects].tolist()}
+
+
+def run_world_from_arguments(arguments):
+    return run_world(*arguments)
+
+
+def run_worlds_in_parallel(scenario_name, seeds, steps, worker_count=None, world_options=None):
+    # Runs one world per seed on a pool of worker_count processes (one per core by default). The summaries come back
+    # in the same order as the seeds.
+    arguments = [(scenario_name, seed, steps, world_options) for seed in seeds]
+    if worker_count == 1:
+        return [run_world_from_arguments(world_arguments) for world_arguments in arguments]
+
+    pool = multiprocessing.Pool(worker_count)
+    try:
+        return pool.map(run_world_from_arguments, arguments, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Runs many seeded worlds of one scenario over a process pool.')
+    parser.add_argument('scenario', choices=sorted(scenarios))
+    parser.add_argument('--seeds', type=int, default=8, help='how many worlds to run, seeded 0, 1, 2, ...')
+    parser.add_argument('--steps', type=int, default=600)
+    parser.add_argument('--workers', type=int, default=None)
+    options = parser.parse_args()
+
+    for summary in run_worlds_in_parallel(options.scenario, range(options.seeds), options.steps, options.workers):
+        print('seed %(seed)d: %(objects)d objects, %(steps_per_second).1f steps/s, kinetic energy %(kinetic_energy).6g, '
+              '%(contacts)d contacts' % summary)
@@ -0,0 +1,196 @@
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy
+
+from scenarios import create_world, scenarios, synthetic_scenarios
+from step_profiler import phase_names
+
+
+__author__ = 'Jacob'
+
+
+# Runs the test scenes and the synthetic scenes headless, and times go_forward_one_time_step() phase by phase with
+# a StepProfiler.
+# Results are written as JSON so two revisions can be compared with --compare. With --workers, every case is also
+# run with World.use_domain_decomposition() for each worker count given (0 meaning without it), to see how it scales
+# with the cores the machine has.
+
+default_object_counts = (10, 100, 1000, 10000, 100000)
+
+
+def run_benchmark_case(case):
+    # Meant to be run in a fresh process, so the peak memory is this case's alone.
+    scenario_name, number_of_objects, seed, maximum_steps, time_budget, worker_count = case
+
+    start_time = time.time()
+    world = create_world(scenario_name, seed, number_of_objects)
+    if worker_count:
+        world.use_domain_decomposition(worker_count)
+    setup_time = time.time() - start_time
+
+    # The first step sets up the broadphase, so it's timed separately from the rest.
+    profiler = world.enable_profiling(maximum_steps)
+    start_time = time.time()
+    world.go_forward_one_time_step()
+    first_step_time = time.time() - start_time
+    profiler.reset()
+
+    steps = 0
+    start_time = time.time()
+    while steps < maximum_steps and (steps == 0 or time.time() - start_time < time_budget):
+        world.go_forward_one_time_step()
+        steps += 1
+    elapsed_time = time.time() - start_time
+    if worker_count:
+        world.stop_domain_decomposition()
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_memory //= 1024
+
+    return {'scenario': scenario_name,
+            'objects': world.space_object_arrays.number_of_objects,
+            'seed': seed,
+            'workers': worker_count,
+            'steps': steps,
+            'setup_seconds': setup_time,
+            'first_step_seconds': first_step_time,
+            'steps_per_second': steps / elapsed_time if elapsed_time > 0. else float('inf'),
+            'phase_seconds_per_step': dict((phase_name, phase_time / steps)
+                                           for phase_name, phase_time in profiler.total_phase_times.items()),
+            'step_statistics': profiler.rolling_statistics(),
+            'peak_memory_kilobytes': peak_memory}
+
+
+def send_benchmark_result(result_connection, case):
+    result_connection.send(run_benchmark_case(case))
+
+
+def run_benchmark_case_in_new_process(case):
+    # A pool's processes can't start processes of their own, which domain decomposition needs, so each case gets a
+    # plain process instead. Only that process holds the sending end of the pipe, so if it dies without a result
+    # (killed for running out of memory, say) recv() raises EOFError rather than waiting forever.
+    receiving_connection, sending_connection = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=send_benchmark_result, args=(sending_connection, case))
+    process.start()
+    sending_connection.close()
+    try:
+        return receiving_connection.recv()
+    finally:
+        process.join()
+
+
+def find_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(scenario_names, object_counts=default_object_counts, seed=0, maximum_steps=100, time_budget=10.,
+                   worker_counts=(0,)):
+    # The test scenes are run once each, and the synthetic ones once for every object count, each of them once for
+    # every worker count. Every case gets its own process, one at a time, so the timings don't fight over cores.
+    cases = []
+    for scenario_name in scenario_names:
+        for worker_count in worker_counts:
+            if scenario_name in synthetic_scenarios:
+                cases.extend((scenario_name, number_of_objects, seed, maximum_steps, time_budget, worker_count)
+                             for number_of_objects in object_counts)
+            else:
+                cases.append((scenario_name, None, seed, maximum_steps, time_budget, worker_count))
+
+    results = []
+    for case in cases:
+        try:
+            result = run_benchmark_case_in_new_process(case)
+        except EOFError:
+            print('%-14s %7s objects  %2d workers  died without a result' % (case[0], case[1], case[5]))
+            sys.stdout.flush()
+            continue
+        print_result(result)
+        results.append(result)
+
+    return {'revision': find_revision(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'machine': platform.platform(),
+            'cores': multiprocessing.cpu_count(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'results': results}
+
+
+def print_result(result):
+    phase_times = result['phase_seconds_per_step']
+    print('%-14s %7d objects  %2d workers  %9.1f steps/s  %s  peak %d kB' %
+          (result['scenario'], result['objects'], result['workers'], result['steps_per_second'],
+           '  '.join('%s %.2e' % (phase_name, phase_times[phase_name]) for phase_name in phase_names),
+           result['peak_memory_kilobytes']))
+    sys.stdout.flush()
+
+
+def compare_benchmarks(old_results, new_results, threshold=.1):
+    # Prints how the steps per second changed for every case the two runs share. Returns the cases that got slower by
+    # more than threshold (as a fraction).
+    # Results from before --workers existed were all run without domain decomposition.
+    old_cases = dict(((result['scenario'], result['objects'], result.get('workers', 0)), result)
+                     for result in old_results['results'])
+    regressions = []
+
+    print('comparing %s to %s' % (old_results.get('revision'), new_results.get('revision')))
+    for new_result in new_results['results']:
+        case = (new_result['scenario'], new_result['objects'], new_result.get('workers', 0))
+        if case not in old_cases:
+            continue
+        old_result = old_cases[case]
+        speedup = new_result['steps_per_second'] / old_result['steps_per_second']
+        regressed = speedup < 1. - threshold
+        if regressed:
+            regressions.append(case)
+        print('%-14s %7d objects  %2d workers  %9.1f -> %9.1f steps/s  x%.2f  peak %d -> %d kB%s' %
+              (case[0], case[1], case[2], old_result['steps_per_second'], new_result['steps_per_second'], speedup,
+               old_result['peak_memory_kilobytes'], new_result['peak_memory_kilobytes'],
+               '  SLOWER' if regressed else ''))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks the physics without any renderer.')
+    parser.add_argument('--scenarios', nargs='+', default=sorted(scenarios) + sorted(synthetic_scenarios),
+                        choices=sorted(scenarios) + sorted(synthetic_scenarios))
+    parser.add_argument('--counts', nargs='+', type=int, default=default_object_counts,
+                        help='object counts for the synthetic scenarios')
+    parser.add_argument('--steps', type=int, default=100, help='the most steps timed for each case')
+    parser.add_argument('--time-budget', type=float, default=10.,
+                        help='stop timing a case after this many seconds, once it has done at least one step')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', nargs='+', type=int, default=[0],
+                        help='run every case with domain decomposition over each of these numbers of workers '
+                             '(0 runs it without)')
+    parser.add_argument('--output', help='where to write the results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running anything')
+    parser.add_argument('--threshold', type=float, default=.1,
+                        help='how much slower a case can get before --compare calls it a regression')
+    options = parser.parse_args()
+
+    if options.compare:
+        with open(options.compare[0]) as old_file, open(options.compare[1]) as new_file:
+            regressions = compare_benchmarks(json.load(old_file), json.load(new_file), options.threshold)
+        sys.exit(1 if regressions else 0)
+
+    benchmark_results = run_benchmarks(options.scenarios, options.counts, options.seed, options.steps, options.time_budget,
+                                       options.workers)
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(benchmark_results, output_file, indent=2, sort_keys=True)
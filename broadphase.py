@@ -0,0 +1,339 @@
+import numpy
+
+from array_helpers import expand_ranges
+
+
+__author__ = 'Jacob'
+
+
+# A broadphase finds the pairs of objects whose bounding boxes overlap, so only those pairs have to be checked
+# properly. Every broadphase is made from the SpaceObjectArrays it works on and has:
+#   objects_changed()                      called when objects are added or resized
+#   object_removed(index, moved_index)     called when the object at index is removed and the one at moved_index
+#                                          (the last one) is moved into its place
+#   update(object_indices=None)            called after the given objects (or all of them) have moved
+#   potentially_colliding_pairs()          the overlapping pairs as two index arrays, sorted by pair code
+# and a swept_volumes flag: when it's set, each object's box covers everywhere it went during the step, from its
+# previous position to its current one, so fast objects can't pass through each other between steps.
+
+
+def make_pair_code(object_indices0, object_indices1):
+    # Packs a pair of object indices into one integer, smaller index first, so a pair has the same code whichever way
+    # round it was found.
+    return (numpy.minimum(object_indices0, object_indices1).astype(numpy.int64) << 32) | numpy.maximum(object_indices0, object_indices1)
+
+
+def split_pair_codes(pair_codes):
+    return pair_codes >> 32, pair_codes & 0xffffffff
+
+
+def calculate_extents(arrays, object_indices, swept_volumes=False):
+    # The additional .01 is so the collision detector will pick up objects that are just barely touching.
+    padded_radii = arrays.radii[object_indices, numpy.newaxis] + .005
+    positions = arrays.positions[object_indices]
+    if not swept_volumes:
+        return positions - padded_radii, positions + padded_radii
+
+    # Immovable objects don't sweep, even if they were put somewhere new by hand since previous_positions was set.
+    previous_positions = numpy.where(arrays.movable[object_indices, numpy.newaxis],
+                                     arrays.previous_positions[object_indices], positions)
+    return (numpy.minimum(positions, previous_positions) - padded_radii,
+            numpy.maximum(positions, previous_positions) + padded_radii)
+
+
+def find_overlapping_boxes(mins, maxes):
+    # All the pairs of boxes that overlap, found from scratch by sorting along x. Returned like
+    # potentially_colliding_pairs(), as indices into mins and maxes.
+    number_of_boxes = len(mins)
+    boxes_by_min = numpy.argsort(mins[:, 0], kind='mergesort')
+    overlap_ends = numpy.searchsorted(mins[boxes_by_min, 0], maxes[boxes_by_min, 0], side='right')
+    first_boxes, second_locations = expand_ranges(numpy.arange(1, number_of_boxes + 1),
+                                                  numpy.maximum(overlap_ends, numpy.arange(1, number_of_boxes + 1)))
+    first_boxes, second_boxes = boxes_by_min[first_boxes], boxes_by_min[second_locations]
+    boxes_overlap = numpy.all((mins[first_boxes] <= maxes[second_boxes]) & (mins[second_boxes] <= maxes[first_boxes]),
+                              axis=1)
+    return split_pair_codes(numpy.sort(make_pair_code(first_boxes[boxes_overlap], second_boxes[boxes_overlap])))
+
+
+def choose_cell_size(mins, maxes):
+    # A cell size for find_overlapping_boxes_in_cells() about as big as most of the boxes.
+    return numpy.percentile(numpy.max(maxes - mins, axis=1), 90) if len(mins) else 1.
+
+
+def find_overlapping_boxes_in_cells(mins, maxes, cell_size, maximum_cells_per_object=64):
+    # The pair codes of all the pairs of boxes that overlap, sorted, found from scratch by bucketing the boxes into the
+    # cells of a uniform grid that they touch. Boxes touching more than maximum_cells_per_object cells are checked
+    # against every box instead. Unlike find_overlapping_boxes() this takes time close to linear in the number of
+    # boxes however they're spread out, as long as most of them are no bigger than a cell.
+    low_cells = numpy.floor(mins / cell_size).astype(numpy.int64)
+    high_cells = numpy.floor(maxes / cell_size).astype(numpy.int64)
+    cell_spans = high_cells - low_cells + 1
+    cells_per_object = numpy.prod(cell_spans, axis=1)
+    oversized = cells_per_object > maximum_cells_per_object
+    regular = numpy.flatnonzero(~oversized)
+    pair_codes = [numpy.zeros(0, dtype=numpy.int64)]
+
+    if len(regular):
+        entry_objects, cell_numbers = expand_ranges(numpy.zeros(len(regular), dtype=numpy.int64),
+                                                    cells_per_object[regular])
+        entry_objects = regular[entry_objects]
+        spans = cell_spans[entry_objects]
+        entry_cells = low_cells[entry_objects] + numpy.column_stack([cell_numbers % spans[:, 0],
+                                                                     (cell_numbers // spans[:, 0]) % spans[:, 1],
+                                                                     cell_numbers // (spans[:, 0] * spans[:, 1])])
+
+        # Numbers the cells that are in use, so objects in the same cell end up next to each other when sorted.
+        entry_cells -= entry_cells.min(axis=0)
+        cell_ranges = entry_cells.max(axis=0) + 1
+        cell_keys = (entry_cells[:, 0] * cell_ranges[1] + entry_cells[:, 1]) * cell_ranges[2] + entry_cells[:, 2]
+        order = numpy.argsort(cell_keys, kind='mergesort')
+        cell_keys = cell_keys[order]
+        entry_objects = entry_objects[order]
+
+        run_starts = numpy.flatnonzero(numpy.concatenate([[True], cell_keys[1:] != cell_keys[:-1]]))
+        run_lengths = numpy.diff(numpy.concatenate([run_starts, [len(cell_keys)]]))
+        run_ends = numpy.repeat(run_starts + run_lengths, run_lengths)
+        first_entries, second_entries = expand_ranges(numpy.arange(1, len(cell_keys) + 1), run_ends)
+        pair_codes.append(make_pair_code(entry_objects[first_entries], entry_objects[second_entries]))
+
+    for oversized_object in numpy.flatnonzero(oversized):
+        overlapping = numpy.flatnonzero(numpy.all((mins <= maxes[oversized_object]) &
+                                                  (mins[oversized_object] <= maxes), axis=1))
+        overlapping = overlapping[overlapping != oversized_object]
+        pair_codes.append(make_pair_code(numpy.full(len(overlapping), oversized_object, dtype=numpy.int64), overlapping))
+
+    # Sharing a cell doesn't mean the boxes overlap, so the pairs are checked before being handed out.
+    pair_codes = numpy.unique(numpy.concatenate(pair_codes))
+    first_objects, second_objects = split_pair_codes(pair_codes)
+    boxes_overlap = numpy.all((mins[first_objects] <= maxes[second_objects]) &
+                              (mins[second_objects] <= maxes[first_objects]), axis=1)
+    return pair_codes[boxes_overlap]
+
+
+class SweepAndPruneBroadphase:
+    def __init__(self, arrays):
+        # For each dimension, endpoint_values has the min and max of every object along that dimension kept in sorted
+        # order, endpoint_objects and endpoint_is_max say whose endpoint each one is, and
+        # endpoint_locations[dimension][object index] is where that object's min and max currently sit in the sorted arrays.
+        self.arrays = arrays
+        self.endpoint_values = [numpy.zeros(0) for dimension_index in xrange(3)]
+        self.endpoint_objects = [numpy.zeros(0, dtype=numpy.int64) for dimension_index in xrange(3)]
+        self.endpoint_is_max = [numpy.zeros(0, dtype=bool) for dimension_index in xrange(3)]
+        self.endpoint_locations = [numpy.zeros((0, 2), dtype=numpy.int64) for dimension_index in xrange(3)]
+        # The pair codes (see make_pair_code()) of the pairs whose boxes overlap, sorted. Pairs that only overlap in
+        # some of the dimensions aren't kept anywhere: there can be far more of them than of real pairs.
+        self.overlapping_pairs = numpy.zeros(0, dtype=numpy.int64)
+        self.needs_rebuild = True
+        # Removed objects' endpoints are marked with an object of -1 and cleared out on the next update.
+        self.has_removed_endpoints = False
+        # Removals reach overlapping_pairs all at once, when the pairs are next needed. Until then
+        # pair_renumbering[index the pairs use] is that object's row now, or -1 once it's removed, and
+        # pair_indices_of_rows[row] is the other way round.
+        self.pair_renumbering = None
+        self.pair_indices_of_rows = None
+        self.swept_volumes = False
+
+    def objects_changed(self):
+        # New objects are sorted in all at once the next time the endpoints are updated.
+        self.needs_rebuild = True
+
+    def rebuild(self):
+        number_of_objects = self.arrays.number_of_objects
+        object_indices = numpy.arange(number_of_objects)
+        mins, maxes = calculate_extents(self.arrays, object_indices, self.swept_volumes)
+
+        for dimension_index in xrange(3):
+            values = numpy.concatenate([mins[:, dimension_index], maxes[:, dimension_index]])
+            is_max = numpy.arange(2 * number_of_objects) >= number_of_objects
+            # Mins go before maxes with the same value, so objects that exactly touch count as overlapping.
+            order = numpy.lexsort((is_max, values))
+            self.endpoint_values[dimension_index] = values[order]
+            self.endpoint_objects[dimension_index] = numpy.concatenate([object_indices, object_indices])[order]
+            self.endpoint_is_max[dimension_index] = is_max[order]
+            self.endpoint_locations[dimension_index] = numpy.empty((number_of_objects, 2), dtype=numpy.int64)
+            self.endpoint_locations[dimension_index][self.endpoint_objects[dimension_index],
+                                                     self.endpoint_is_max[dimension_index].astype(numpy.int64)] = \
+                numpy.arange(2 * number_of_objects)
+
+        # Sweeping along one dimension from scratch would look at every pair overlapping in it, so the pairs are found
+        # on a grid instead, with cells about as big as most boxes.
+        self.overlapping_pairs = find_overlapping_boxes_in_cells(mins, maxes, choose_cell_size(mins, maxes))
+        self.needs_rebuild = False
+        self.has_removed_endpoints = False
+        self.pair_renumbering = None
+        self.pair_indices_of_rows = None
+
+    def object_removed(self, object_index, moved_object_index):
+        # Takes constant time: the removed object's pairs are dropped and the moved object's pairs renumbered by
+        # renumber_pairs(), once for every removal since the pairs were last needed, and the removed object's
+        # endpoints are only taken out of the sorted arrays on the next update.
+        if self.needs_rebuild:
+            return
+
+        if self.pair_renumbering is None:
+            # The last row is the one moved, so there were moved_object_index + 1 objects when the pairs were found.
+            self.pair_renumbering = numpy.arange(moved_object_index + 1)
+            self.pair_indices_of_rows = numpy.arange(moved_object_index + 1)
+        self.pair_renumbering[self.pair_indices_of_rows[object_index]] = -1
+        if moved_object_index != object_index:
+            moved_pair_index = self.pair_indices_of_rows[moved_object_index]
+            self.pair_renumbering[moved_pair_index] = object_index
+            self.pair_indices_of_rows[object_index] = moved_pair_index
+
+        for dimension_index in xrange(3):
+            locations = self.endpoint_locations[dimension_index]
+            self.endpoint_objects[dimension_index][locations[object_index]] = -1
+            if moved_object_index != object_index:
+                self.endpoint_objects[dimension_index][locations[moved_object_index]] = object_index
+                locations[object_index] = locations[moved_object_index]
+        self.has_removed_endpoints = True
+
+    def renumber_pairs(self):
+        first_objects, second_objects = split_pair_codes(self.overlapping_pairs)
+        first_objects, second_objects = self.pair_renumbering[first_objects], self.pair_renumbering[second_objects]
+        kept = (first_objects >= 0) & (second_objects >= 0)
+        self.overlapping_pairs = numpy.sort(make_pair_code(first_objects[kept], second_objects[kept]))
+        self.pair_renumbering = None
+        self.pair_indices_of_rows = None
+
+    def clear_removed_endpoints(self):
+        for dimension_index in xrange(3):
+            kept = self.endpoint_objects[dimension_index] >= 0
+            self.endpoint_values[dimension_index] = self.endpoint_values[dimension_index][kept]
+            self.endpoint_objects[dimension_index] = self.endpoint_objects[dimension_index][kept]
+            self.endpoint_is_max[dimension_index] = self.endpoint_is_max[dimension_index][kept]
+            self.endpoint_locations[dimension_index] = numpy.empty((self.arrays.number_of_objects, 2), dtype=numpy.int64)
+            self.endpoint_locations[dimension_index][self.endpoint_objects[dimension_index],
+                                                     self.endpoint_is_max[dimension_index].astype(numpy.int64)] = \
+                numpy.arange(len(self.endpoint_values[dimension_index]))
+        self.has_removed_endpoints = False
+
+    def update(self, object_indices=None):
+        if self.needs_rebuild:
+            self.rebuild()
+            return
+        if self.has_removed_endpoints:
+            self.clear_removed_endpoints()
+        if self.pair_renumbering is not None:
+            self.renumber_pairs()
+
+        if object_indices is None:
+            object_indices = numpy.arange(self.arrays.number_of_objects)
+        if not len(object_indices):
+            return
+        mins, maxes = calculate_extents(self.arrays, object_indices, self.swept_volumes)
+
+        for dimension_index in xrange(3):
+            locations = self.endpoint_locations[dimension_index][object_indices]
+            self.endpoint_values[dimension_index][locations[:, 0]] = mins[:, dimension_index]
+            self.endpoint_values[dimension_index][locations[:, 1]] = maxes[:, dimension_index]
+
+        # Only the pairs whose min and max swapped places in some dimension can have started or stopped overlapping.
+        # Each of them is looked at again with the boxes the objects have now, once every dimension is sorted.
+        swapped_pairs_in_each_dimension = [self.sort_dimension(dimension_index) for dimension_index in xrange(3)]
+        if any(swapped_pairs is None for swapped_pairs in swapped_pairs_in_each_dimension):
+            self.find_all_overlapping_pairs()
+            return
+        swapped_pairs = numpy.unique(numpy.concatenate(swapped_pairs_in_each_dimension))
+        if not len(swapped_pairs):
+            return
+        first_objects, second_objects = split_pair_codes(swapped_pairs)
+        overlapping = numpy.ones(len(swapped_pairs), dtype=bool)
+        for dimension_index in xrange(3):
+            values = self.endpoint_values[dimension_index]
+            locations = self.endpoint_locations[dimension_index]
+            overlapping &= ((values[locations[first_objects, 0]] <= values[locations[second_objects, 1]]) &
+                            (values[locations[second_objects, 0]] <= values[locations[first_objects, 1]]))
+
+        unchanged_pairs = self.overlapping_pairs[~numpy.in1d(self.overlapping_pairs, swapped_pairs)]
+        self.overlapping_pairs = numpy.sort(numpy.concatenate([unchanged_pairs, swapped_pairs[overlapping]]))
+
+    def find_all_overlapping_pairs(self):
+        # Finds the pairs from scratch, on a grid like rebuild(), with the boxes the endpoints have now.
+        number_of_objects = self.arrays.number_of_objects
+        mins = numpy.empty((number_of_objects, 3))
+        maxes = numpy.empty((number_of_objects, 3))
+        for dimension_index in xrange(3):
+            locations = self.endpoint_locations[dimension_index]
+            mins[:, dimension_index] = self.endpoint_values[dimension_index][locations[:, 0]]
+            maxes[:, dimension_index] = self.endpoint_values[dimension_index][locations[:, 1]]
+        self.overlapping_pairs = find_overlapping_boxes_in_cells(mins, maxes, choose_cell_size(mins, maxes))
+
+    def sort_dimension(self, dimension_index):
+        # Puts the endpoints back in order and returns the pair codes of the objects whose min and max swapped places
+        # on the way. From one step to the next objects barely move, so only a few endpoints are out of order, and
+        # only the endpoints each of those moved past are looked at. Every swap is found at once rather than one at a
+        # time: an endpoint that moved from location a to b swapped with everything that was between a and b before
+        # the sort, or is between them after it. When endpoints moved past so many others that listing them would
+        # cost more than finding the pairs from scratch, returns None instead.
+        values = self.endpoint_values[dimension_index]
+        objects = self.endpoint_objects[dimension_index]
+        is_max = self.endpoint_is_max[dimension_index]
+        if not numpy.any((values[1:] < values[:-1]) | ((values[1:] == values[:-1]) & is_max[:-1] & ~is_max[1:])):
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        order = numpy.lexsort((is_max, values))
+        new_locations = numpy.empty(len(order), dtype=numpy.int64)
+        new_locations[order] = numpy.arange(len(order))
+        moved = numpy.flatnonzero(new_locations != numpy.arange(len(order)))
+        ranges_start = numpy.minimum(moved, new_locations[moved])
+        ranges_end = numpy.maximum(moved, new_locations[moved]) + 1
+        pair_codes = None
+        if numpy.sum(ranges_end - ranges_start) <= 4 * len(order):
+            moved_rows, passed_locations = expand_ranges(ranges_start, ranges_end)
+            moving = numpy.concatenate([moved[moved_rows], moved[moved_rows]])
+            # The endpoints at those locations before the sort, and the ones there after it.
+            passed = numpy.concatenate([passed_locations, order[passed_locations]])
+
+            swapped = ((moving - passed) * (new_locations[moving] - new_locations[passed]) < 0) & \
+                      (is_max[moving] != is_max[passed])
+            pair_codes = make_pair_code(objects[moving[swapped]], objects[passed[swapped]])
+
+        self.endpoint_values[dimension_index] = values[order]
+        self.endpoint_objects[dimension_index] = objects[order]
+        self.endpoint_is_max[dimension_index] = is_max[order]
+        self.endpoint_locations[dimension_index][objects, is_max.astype(numpy.int64)] = new_locations
+        return pair_codes
+
+    def potentially_colliding_pairs(self):
+        if self.pair_renumbering is not None:
+            self.renumber_pairs()
+        return split_pair_codes(self.overlapping_pairs)
+
+
+class SpatialHashBroadphase:
+    # Buckets every object into the cells of a uniform grid that its bounding box touches, and pairs up objects that
+    # share a cell. Unlike sweep and prune it doesn't care how objects are lined up, but it starts from scratch each
+    # time. The cell size comes from the radius distribution so most objects touch no more than 8 cells; objects
+    # touching more than maximum_cells_per_object (planets among debris, say) are checked against everything instead.
+    def __init__(self, arrays, cell_size=None, maximum_cells_per_object=64):
+        self.arrays = arrays
+        self.chosen_cell_size = cell_size
+        self.cell_size = cell_size
+        self.maximum_cells_per_object = maximum_cells_per_object
+        self.pair_codes = None
+        self.swept_volumes = False
+
+    def objects_changed(self):
+        self.pair_codes = None
+        if self.chosen_cell_size is None:
+            radii = self.arrays.radii[:self.arrays.number_of_objects] + .005
+            self.cell_size = 2. * numpy.percentile(radii, 90) if len(radii) else 1.
+
+    def object_removed(self, object_index, moved_object_index):
+        self.pair_codes = None
+
+    def update(self, object_indices=None):
+        self.pair_codes = None
+
+    def potentially_colliding_pairs(self):
+        if self.pair_codes is None:
+            self.pair_codes = self.find_pair_codes()
+        return split_pair_codes(self.pair_codes)
+
+    def find_pair_codes(self):
+        if self.cell_size is None:
+            self.objects_changed()
+
+        mins, maxes = calculate_extents(self.arrays, numpy.arange(self.arrays.number_of_objects), self.swept_volumes)
+        return find_overlapping_boxes_in_cells(mins, maxes, self.cell_size, self.maximum_cells_per_object)
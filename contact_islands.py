@@ -0,0 +1,128 @@
+import multiprocessing
+import numpy
+
+
+__author__ = 'Jacob'
+
+
+def find_contact_islands(first_objects, second_objects, movable, number_of_objects):
+    # Splits the contacts into islands: groups that share no movable objects, so each group can be solved on its own.
+    # Immovable objects never have their velocity changed, so they don't join islands together.
+    # Returns the island number of each contact, or -1 for contacts between two immovable objects.
+    labels = numpy.arange(number_of_objects)
+    linking = movable[first_objects] & movable[second_objects]
+    linked_first, linked_second = first_objects[linking], second_objects[linking]
+
+    while True:
+        new_labels = labels.copy()
+        numpy.minimum.at(new_labels, linked_first, labels[linked_second])
+        numpy.minimum.at(new_labels, linked_second, labels[linked_first])
+        new_labels = new_labels[new_labels]
+        if numpy.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    contact_labels = numpy.where(movable[first_objects], labels[first_objects], labels[second_objects])
+    contact_labels[~movable[first_objects] & ~movable[second_objects]] = -1
+    used_labels, islands = numpy.unique(contact_labels, return_inverse=True)
+    if len(used_labels) and used_labels[0] == -1:
+        islands -= 1
+    return islands
+
+
+def apply_impulses(island):
+    # Applies the impulses for one island's contacts, one after another in the order they were found. Returns the
+    # island's new velocities.
+    first_objects, second_objects, positions, velocities, masses, movable, e = island
+    positions = positions.tolist()
+    velocities = velocities.tolist()
+
+    for space_object0, space_object1 in zip(first_objects.tolist(), second_objects.tolist()):
+        position0, position1 = positions[space_object0], positions[space_object1]
+        velocity0, velocity1 = velocities[space_object0], velocities[space_object1]
+
+        contact_normal_not_unit = [position0[k] - position1[k] for k in xrange(3)]
+        normal_length = sum(component * component for component in contact_normal_not_unit) ** .5
+        if normal_length == 0.:
+            continue
+        contact_normal = [component / normal_length for component in contact_normal_not_unit]
+        object0_speed_along_normal = sum(velocity0[k] * contact_normal[k] for k in xrange(3))
+        object1_speed_along_normal = sum(velocity1[k] * contact_normal[k] for k in xrange(3))
+        object0_relative_velocity = [object0_speed_along_normal * component for component in contact_normal]
+        object1_relative_velocity = [object1_speed_along_normal * component for component in contact_normal]
+
+        vector_velocity_difference = [object0_relative_velocity[k] - object1_relative_velocity[k] for k in xrange(3)]
+
+        if sum(vector_velocity_difference[k] * contact_normal[k] for k in xrange(3)) >= 0:
+            pass
+
+        elif movable[space_object0] and movable[space_object1]:
+            mass0, mass1 = masses[space_object0], masses[space_object1]
+            impulse = [(1 + e) * component * ((mass0 * mass1) / (mass0 + mass1)) for component in vector_velocity_difference]
+
+            velocities[space_object0] = [velocity0[k] - impulse[k] / mass0 for k in xrange(3)]
+            velocities[space_object1] = [velocity1[k] + impulse[k] / mass1 for k in xrange(3)]
+
+        elif movable[space_object0]:
+            velocities[space_object0] = [e * (-2 * object0_relative_velocity[k] + velocity0[k]) for k in xrange(3)]
+
+        elif movable[space_object1]:
+            velocities[space_object1] = [e * (-2 * object1_relative_velocity[k] + velocity1[k]) for k in xrange(3)]
+
+    return numpy.array(velocities).reshape(-1, 3)
+
+
+def apply_impulses_to_islands(islands):
+    return [apply_impulses(island) for island in islands]
+
+
+class ContactIslandResolver:
+    # Resolves each contact island on its own, either here or spread over a pool of worker processes. Every island
+    # goes through apply_impulses() in the same order either way, so the results don't depend on the worker count.
+    def __init__(self, worker_count=1, minimum_contacts_for_workers=2000):
+        self.worker_count = worker_count or multiprocessing.cpu_count()
+        self.minimum_contacts_for_workers = minimum_contacts_for_workers
+        self.pool = None
+
+    def resolve(self, arrays, first_objects, second_objects, e):
+        islands = find_contact_islands(first_objects, second_objects, arrays.movable, arrays.number_of_objects)
+        number_of_islands = islands.max() + 1 if len(islands) else 0
+        contacts_by_island = numpy.argsort(islands, kind='mergesort')
+        # Contacts with no island (-1) sort to the front and are skipped over.
+        island_starts = numpy.searchsorted(islands[contacts_by_island], numpy.arange(number_of_islands + 1))
+
+        island_objects = []
+        island_arguments = []
+        largest_island = 0
+        for island_number in xrange(number_of_islands):
+            contacts = contacts_by_island[island_starts[island_number]:island_starts[island_number + 1]]
+            objects, local_objects = numpy.unique(numpy.concatenate([first_objects[contacts], second_objects[contacts]]),
+                                                  return_inverse=True)
+            island_objects.append(objects)
+            island_arguments.append((local_objects[:len(contacts)], local_objects[len(contacts):],
+                                     arrays.positions[objects], arrays.velocities[objects], arrays.masses[objects],
+                                     arrays.movable[objects], e))
+            largest_island = max(largest_island, numpy.count_nonzero(arrays.movable[objects]))
+
+        if self.worker_count > 1 and number_of_islands > 1 and len(first_objects) >= self.minimum_contacts_for_workers:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.worker_count)
+            # Islands are dealt out round robin so each worker gets a mix of big and small ones.
+            batches = [island_arguments[worker::self.worker_count] for worker in xrange(self.worker_count)]
+            batch_velocities = self.pool.map(apply_impulses_to_islands, batches)
+            island_velocities = [None] * number_of_islands
+            for worker, velocities in enumerate(batch_velocities):
+                island_velocities[worker::self.worker_count] = velocities
+        else:
+            island_velocities = apply_impulses_to_islands(island_arguments)
+
+        for objects, velocities in zip(island_objects, island_velocities):
+            movable = arrays.movable[objects]
+            arrays.velocities[objects[movable]] = velocities[movable]
+
+        return {'contact_islands': number_of_islands, 'largest_contact_island': largest_island}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
@@ -0,0 +1,311 @@
+import mmap
+import multiprocessing
+
+import numpy
+
+from array_helpers import expand_ranges
+from barnes_hut_octree import BarnesHutOctree
+from broadphase import calculate_extents, choose_cell_size, find_overlapping_boxes_in_cells, make_pair_code, \
+    split_pair_codes
+
+
+__author__ = 'Jacob'
+
+
+# Splits a world into slabs along x, one for each worker process, and has each worker integrate, work out the
+# gravity on, and find the overlapping boxes of the objects in its slab. The world's arrays live in shared memory, so
+# the workers read and write them in place and only small things (slab boundaries, pair codes) are passed around.
+# Which slab an object is in is worked out again from where it is every time, so objects that cross a boundary are
+# simply the next slab's from then on. The back-off and the impulses still run in the main process, on the pairs the
+# workers found.
+# Things every slab needs, like the gravity octree and the cached gravity field, are built once by the main process:
+# the octree is copied into a shared arena each step, and the cached field is built before the workers are forked,
+# so the workers only walk or look them up.
+
+# The workers have to be forked so they share the arrays, which is all Python 2 does on Linux.
+try:
+    process_context = multiprocessing.get_context('fork')
+except AttributeError:
+    process_context = multiprocessing
+
+
+def allocate_shared_array(shape, dtype=float):
+    # A zeroed array in anonymous shared memory, which processes forked after it was made read and write directly.
+    dtype = numpy.dtype(dtype)
+    count = int(numpy.prod(shape))
+    shared_memory = mmap.mmap(-1, max(count * dtype.itemsize, 1))
+    return numpy.frombuffer(shared_memory, dtype=dtype, count=count).reshape(shape)
+
+
+# The DomainDecomposition the workers were forked from. Each worker has its own copy, sharing its arrays.
+forked_decomposition = None
+
+
+def run_slab_task(task):
+    task_name, slab, number_of_objects, arguments = task
+    forked_decomposition.catch_up(number_of_objects)
+    return getattr(forked_decomposition, task_name)(slab, *arguments)
+
+
+def run_slab_task_here(decomposition, task):
+    task_name, slab, number_of_objects, arguments = task
+    return getattr(decomposition, task_name)(slab, *arguments)
+
+
+class DomainDecomposition:
+    # The workers are started the first time they're needed, and started again whenever the arrays grow, since new
+    # arrays are only shared with processes forked after they were made.
+    def __init__(self, world, worker_count=None):
+        self.world = world
+        self.arrays = world.space_object_arrays
+        self.worker_count = worker_count or multiprocessing.cpu_count()
+        self.arrays.use_array_allocator(allocate_shared_array)
+        self.pool = None
+        self.forked_capacity = None
+        self.forked_arena = None
+        self.forked_gravity_field = None
+        # Where the main process puts arrays that change every step for the workers to read, see share_arrays().
+        self.arena = None
+        # Where the main process tells the workers what's in each slab, and where they put what they work out.
+        self.scratch_capacity = None
+        self.allocate_scratch_arrays()
+
+    def allocate_scratch_arrays(self):
+        capacity = self.arrays.capacity
+        self.owning_slabs = allocate_shared_array(capacity, numpy.int64)
+        self.gravitational_accelerations = allocate_shared_array((capacity, 3))
+        self.box_mins = allocate_shared_array((capacity, 3))
+        self.box_maxes = allocate_shared_array((capacity, 3))
+        self.scratch_capacity = capacity
+
+    def start_workers(self):
+        global forked_decomposition
+        self.close()
+        forked_decomposition = self
+        self.pool = process_context.Pool(self.worker_count)
+        self.forked_capacity = self.arrays.capacity
+        self.forked_arena = self.arena
+        self.forked_gravity_field = self.world.cached_gravity_field
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def run_slab_tasks(self, task_name, arguments=()):
+        # Runs the task for every slab, on the workers if there's more than one, and returns what each slab's gave.
+        tasks = [(task_name, slab, self.arrays.number_of_objects, arguments) for slab in xrange(self.worker_count)]
+        if self.worker_count == 1:
+            return [run_slab_task_here(self, task) for task in tasks]
+
+        # Workers only see shared memory and a cached field that existed when they were forked.
+        if (self.pool is None or self.forked_capacity != self.arrays.capacity or self.forked_arena is not self.arena or
+                self.forked_gravity_field is not self.world.cached_gravity_field):
+            self.start_workers()
+        return self.pool.map(run_slab_task, tasks, chunksize=1)
+
+    def catch_up(self, number_of_objects):
+        # A worker's copy of the world is as old as the worker, so it's told how many objects there are now and forgets
+        # which rows had which flags.
+        self.arrays.number_of_objects = number_of_objects
+        self.arrays.cached_indices.clear()
+
+    def share_arrays(self, named_arrays):
+        # Copies the arrays into the arena, making it bigger if they don't fit, and returns where they are:
+        # {name: (offset, dtype, shape)}, for shared_arrays() to find them from.
+        sizes = [-(-array.nbytes // 8) * 8 for array in named_arrays.values()]
+        if self.arena is None or len(self.arena) < sum(sizes):
+            self.arena = allocate_shared_array(2 * sum(sizes), numpy.uint8)
+
+        descriptions = {}
+        offset = 0
+        for (array_name, array), size in zip(named_arrays.items(), sizes):
+            array = numpy.ascontiguousarray(array)
+            self.arena[offset:offset + array.nbytes] = array.reshape(-1).view(numpy.uint8)
+            descriptions[array_name] = (offset, array.dtype.str, array.shape)
+            offset += size
+        return descriptions
+
+    def shared_arrays(self, descriptions):
+        return dict((array_name, self.arena[offset:offset + numpy.dtype(dtype).itemsize * int(numpy.prod(shape))]
+                     .view(dtype).reshape(shape))
+                    for array_name, (offset, dtype, shape) in descriptions.items())
+
+    def assign_slabs(self, object_indices):
+        # Splits the given objects into slabs holding about as many of them each, by their x coordinate.
+        # The rest of the objects aren't in any slab.
+        if self.scratch_capacity != self.arrays.capacity:
+            self.allocate_scratch_arrays()
+        owning_slabs = self.owning_slabs[:self.arrays.number_of_objects]
+        owning_slabs[:] = -1
+        if len(object_indices):
+            x_coordinates = self.arrays.positions[object_indices, 0]
+            boundaries = numpy.percentile(x_coordinates, numpy.linspace(0., 100., self.worker_count + 1)[1:-1])
+            owning_slabs[object_indices] = numpy.searchsorted(boundaries, x_coordinates, side='right')
+
+    def owned_objects(self, slab):
+        return numpy.flatnonzero(self.owning_slabs[:self.arrays.number_of_objects] == slab)
+
+    # What the main process calls.
+
+    def move_objects(self, object_indices, time_step):
+        self.assign_slabs(object_indices)
+        self.run_slab_tasks('move_slab', (time_step,))
+
+    def calculate_gravitational_accelerations(self, target_indices):
+        world = self.world
+        self.assign_slabs(target_indices)
+        gravity_settings = {'mutual_gravity': world.mutual_gravity,
+                            'opening_angle': world.opening_angle,
+                            'softening_length': world.softening_length,
+                            'cached_gravity_field_enabled': world.cached_gravity_field_enabled,
+                            'gravity_field_cells_per_side': world.gravity_field_cells_per_side}
+        world.update_cached_gravity_field()
+        octree_descriptions = None
+        if world.mutual_gravity:
+            attractors, octree = world.build_gravity_octree()
+            if octree is not None:
+                octree_arrays = dict((array_name, getattr(octree, array_name)) for array_name in octree.array_names)
+                octree_arrays['attractors'] = attractors
+                octree_descriptions = self.share_arrays(octree_arrays)
+        self.run_slab_tasks('calculate_slab_gravity', (gravity_settings, octree_descriptions))
+        return self.gravitational_accelerations[target_indices]
+
+    def find_overlapping_pair_codes(self, swept_volumes):
+        arrays = self.arrays
+        number_of_objects = arrays.number_of_objects
+        if self.scratch_capacity != arrays.capacity:
+            self.allocate_scratch_arrays()
+
+        mins, maxes = calculate_extents(arrays, numpy.arange(number_of_objects), swept_volumes)
+        self.box_mins[:number_of_objects] = mins
+        self.box_maxes[:number_of_objects] = maxes
+
+        # Kept so update_overlapping_pair_codes() can find the pairs of a few objects that moved without the workers.
+        self.boxes_by_min_x = numpy.argsort(mins[:, 0], kind='mergesort')
+        self.sorted_min_xs = mins[self.boxes_by_min_x, 0]
+        self.widest_box_x = numpy.max(maxes[:, 0] - mins[:, 0]) if number_of_objects else 0.
+        self.moved_since_sorted = numpy.zeros(number_of_objects, dtype=bool)
+        # Every slab uses the same cells, sized for all the boxes.
+        self.cell_size = choose_cell_size(mins, maxes)
+
+        if not number_of_objects:
+            return numpy.zeros(0, dtype=numpy.int64)
+        boundaries = numpy.percentile(.5 * (mins[:, 0] + maxes[:, 0]),
+                                      numpy.linspace(0., 100., self.worker_count + 1)[1:-1])
+        return numpy.sort(numpy.concatenate(self.run_slab_tasks('find_slab_pair_codes', (boundaries, self.cell_size))))
+
+    def update_overlapping_pair_codes(self, pair_codes, moved_objects, swept_volumes):
+        # The pair codes after the given objects moved, given the ones from before, found in this process. Returns None
+        # once so many objects have moved since the workers last found the pairs that they should find them again.
+        arrays = self.arrays
+        number_of_objects = arrays.number_of_objects
+        moved_since_sorted = self.moved_since_sorted
+        moved_since_sorted[moved_objects] = True
+        stale_objects = numpy.flatnonzero(moved_since_sorted)
+        if len(stale_objects) * 8 > number_of_objects:
+            return None
+
+        mins, maxes = calculate_extents(arrays, moved_objects, swept_volumes)
+        self.box_mins[moved_objects] = mins
+        self.box_maxes[moved_objects] = maxes
+        box_mins, box_maxes = self.box_mins[:number_of_objects], self.box_maxes[:number_of_objects]
+
+        # Objects that haven't moved since the sort are still where it put them, and any of them overlapping a moved
+        # object starts along x between the moved object's min less the widest box and its max.
+        starts = numpy.searchsorted(self.sorted_min_xs, mins[:, 0] - self.widest_box_x, side='left')
+        ends = numpy.searchsorted(self.sorted_min_xs, maxes[:, 0], side='right')
+        rows, locations = expand_ranges(starts, ends)
+        first_objects, second_objects = moved_objects[rows], self.boxes_by_min_x[locations]
+        unmoved = ~moved_since_sorted[second_objects]
+        first_objects, second_objects = first_objects[unmoved], second_objects[unmoved]
+        overlapping = numpy.all((box_mins[first_objects] <= box_maxes[second_objects]) &
+                                (box_mins[second_objects] <= box_maxes[first_objects]), axis=1)
+        new_pair_codes = [make_pair_code(first_objects[overlapping], second_objects[overlapping])]
+
+        # The objects that have moved since are few enough to check against each other from scratch.
+        moved_now = numpy.zeros(number_of_objects, dtype=bool)
+        moved_now[moved_objects] = True
+        first_boxes, second_boxes = split_pair_codes(find_overlapping_boxes_in_cells(
+            box_mins[stale_objects], box_maxes[stale_objects], self.cell_size))
+        first_objects, second_objects = stale_objects[first_boxes], stale_objects[second_boxes]
+        involves_moved = moved_now[first_objects] | moved_now[second_objects]
+        new_pair_codes.append(make_pair_code(first_objects[involves_moved], second_objects[involves_moved]))
+
+        first_objects, second_objects = split_pair_codes(pair_codes)
+        new_pair_codes.append(pair_codes[~(moved_now[first_objects] | moved_now[second_objects])])
+        return numpy.sort(numpy.concatenate(new_pair_codes))
+
+    # What the workers run, one slab each.
+
+    def move_slab(self, slab, time_step):
+        # The same Velocity Verlet step as World.move_all_movable_objects(). With no time step, every object is moved
+        # over all the time since it was last updated, see World.use_level_of_detail().
+        arrays = self.arrays
+        objects = self.owned_objects(slab)
+        if time_step is None:
+            time_step = arrays.time_since_update[objects, numpy.newaxis]
+        arrays.previous_positions[objects] = arrays.positions[objects]
+        arrays.positions[objects] = (arrays.positions[objects] + arrays.velocities[objects] * time_step +
+                                     .5 * arrays.accelerations[objects] * time_step * time_step)
+
+    def calculate_slab_gravity(self, slab, gravity_settings, octree_descriptions):
+        # The cached field, if there is one, was built before this worker was forked, so it's only looked up here.
+        world = self.world
+        for setting_name, setting in gravity_settings.items():
+            setattr(world, setting_name, setting)
+        targets = self.owned_objects(slab)
+        accelerations = world.calculate_source_gravitational_accelerations(targets)
+        if world.mutual_gravity:
+            attractors_and_octree = (numpy.zeros(0, dtype=numpy.int64), None)
+            if octree_descriptions is not None:
+                octree_arrays = self.shared_arrays(octree_descriptions)
+                attractors_and_octree = (octree_arrays['attractors'], BarnesHutOctree.from_arrays(octree_arrays))
+            accelerations += world.calculate_mutual_gravitational_accelerations(targets, attractors_and_octree)
+        self.gravitational_accelerations[targets] = accelerations
+
+    def find_slab_pair_codes(self, slab, boundaries, cell_size):
+        # Looks at the boxes that reach into the slab, its own and the halo of boxes from either side that cross into
+        # it, and keeps the pairs whose overlap along x starts inside it, so every pair is found by exactly one slab.
+        number_of_objects = self.arrays.number_of_objects
+        lower_boundary = boundaries[slab - 1] if slab > 0 else -numpy.inf
+        upper_boundary = boundaries[slab] if slab < len(boundaries) else numpy.inf
+        mins, maxes = self.box_mins[:number_of_objects], self.box_maxes[:number_of_objects]
+
+        boxes = numpy.flatnonzero((mins[:, 0] < upper_boundary) & (maxes[:, 0] >= lower_boundary))
+        first_boxes, second_boxes = split_pair_codes(find_overlapping_boxes_in_cells(mins[boxes], maxes[boxes],
+                                                                                     cell_size))
+        first_objects, second_objects = boxes[first_boxes], boxes[second_boxes]
+        overlap_starts = numpy.maximum(mins[first_objects, 0], mins[second_objects, 0])
+        owned = (overlap_starts >= lower_boundary) & (overlap_starts < upper_boundary)
+        return make_pair_code(first_objects[owned], second_objects[owned])
+
+
+class DomainDecomposedBroadphase:
+    # A broadphase (see broadphase.py) that has a DomainDecomposition's workers find the overlapping boxes slab by
+    # slab. It starts from scratch after objects are added or removed, or once many have moved; the few objects
+    # moved by the back-off between those have their pairs found in this process.
+    def __init__(self, arrays, decomposition):
+        self.arrays = arrays
+        self.decomposition = decomposition
+        self.pair_codes = None
+        self.swept_volumes = False
+
+    def objects_changed(self):
+        self.pair_codes = None
+
+    def object_removed(self, object_index, moved_object_index):
+        self.pair_codes = None
+
+    def update(self, object_indices=None):
+        if self.pair_codes is None or object_indices is None:
+            self.pair_codes = None
+        elif len(object_indices):
+            self.pair_codes = self.decomposition.update_overlapping_pair_codes(self.pair_codes, object_indices,
+                                                                               self.swept_volumes)
+
+    def potentially_colliding_pairs(self):
+        if self.pair_codes is None:
+            self.pair_codes = self.decomposition.find_overlapping_pair_codes(self.swept_volumes)
+        return split_pair_codes(self.pair_codes)
@@ -0,0 +1,124 @@
+import numpy
+
+from array_helpers import expand_ranges
+
+
+__author__ = 'Jacob'
+
+
+def calculate_pairwise_accelerations(target_positions, source_positions, source_masses):
+    # The acceleration each source puts on the target in the same row.
+    distance_vectors = source_positions - target_positions
+    distances_squared = numpy.sum(distance_vectors * distance_vectors, axis=1)
+    # A target sitting exactly on a source has no direction to be pulled in.
+    distances_squared[distances_squared == 0.] = numpy.inf
+    return (source_masses / (distances_squared * numpy.sqrt(distances_squared)))[:, numpy.newaxis] * distance_vectors
+
+
+class CachedGravityField:
+    # The acceleration field of a fixed set of gravity sources, sampled once onto a uniform grid and then looked up
+    # by trilinear interpolation. Close to a source the field bends too sharply for the grid to follow, so every cell
+    # keeps a list of the sources near it, and the field at its corners without those sources. Inside a cell, only
+    # that smooth field of the far sources is interpolated, and the near sources are added exactly. Positions outside
+    # the grid go to exact_accelerations() instead.
+    # Trilinear interpolation of a function is off by at most |cell size|^2 / 8 times its largest second derivative,
+    # which for a source of mass m at distance r is 6 m / r^4. So a source counts as near a cell when it is close
+    # enough for that to be more than maximum_error somewhere in the cell. By default maximum_error is 0.3% of
+    # the median field strength on the grid.
+    def __init__(self, exact_accelerations, source_positions, source_masses, source_radii, cells_per_side=64,
+                 padding=None, maximum_error=None):
+        self.exact_accelerations = exact_accelerations
+        self.source_positions = source_positions
+        self.source_masses = source_masses
+        self.cells_per_side = cells_per_side
+
+        lower_corner = numpy.min(source_positions - source_radii[:, numpy.newaxis], axis=0)
+        upper_corner = numpy.max(source_positions + source_radii[:, numpy.newaxis], axis=0)
+        if padding is None:
+            padding = .5 * max(numpy.max(upper_corner - lower_corner), 1.)
+        self.lower_corner = lower_corner - padding
+        self.cell_size = (upper_corner + padding - self.lower_corner) / cells_per_side
+
+        grid_indices = numpy.arange(cells_per_side + 1)
+        grid_points = numpy.stack(numpy.meshgrid(grid_indices, grid_indices, grid_indices, indexing='ij'), axis=-1)
+        grid_points = self.lower_corner + grid_points.reshape(-1, 3) * self.cell_size
+        field = exact_accelerations(grid_points).reshape(cells_per_side + 1, cells_per_side + 1, cells_per_side + 1, 3)
+
+        if maximum_error is None:
+            maximum_error = 3e-3 * numpy.median(numpy.sqrt(numpy.sum(field * field, axis=3)))
+        cell_diagonal = numpy.linalg.norm(self.cell_size)
+        near_distances = numpy.maximum((.75 * source_masses * cell_diagonal**2 / maximum_error)**.25, source_radii)
+        self.find_near_sources(near_distances)
+
+        # far_fields[cell number, corner number] is the field at that corner of the cell, from the sources that
+        # aren't near the cell. Corners are numbered in numpy.ndindex(2, 2, 2) order.
+        cells = numpy.stack(numpy.unravel_index(numpy.arange(cells_per_side**3), (cells_per_side,) * 3), axis=-1)
+        self.far_fields = numpy.stack([field[cells[:, 0] + corner[0], cells[:, 1] + corner[1], cells[:, 2] + corner[2]]
+                                       for corner in numpy.ndindex(2, 2, 2)], axis=1)
+        near_cells = numpy.repeat(numpy.arange(cells_per_side**3), numpy.diff(self.near_source_starts))
+        for corner_number, corner in enumerate(numpy.ndindex(2, 2, 2)):
+            corner_positions = self.lower_corner + (cells[near_cells] + corner) * self.cell_size
+            near_accelerations = calculate_pairwise_accelerations(corner_positions,
+                                                                  source_positions[self.near_sources],
+                                                                  source_masses[self.near_sources])
+            for dimension_index in xrange(3):
+                self.far_fields[:, corner_number, dimension_index] -= numpy.bincount(
+                    near_cells, near_accelerations[:, dimension_index], minlength=cells_per_side**3)
+
+    def find_near_sources(self, near_distances):
+        # Lists, for every cell, the sources within their near distance of some point of it, the way a CSR matrix
+        # stores its rows: the sources near cell c are near_sources[near_source_starts[c]:near_source_starts[c + 1]],
+        # with cells numbered in C order.
+        cells_per_side = self.cells_per_side
+        cell_diagonal = numpy.linalg.norm(self.cell_size)
+        near_cells = [numpy.zeros(0, dtype=numpy.int64)]
+        near_sources = [numpy.zeros(0, dtype=numpy.int64)]
+        for source, (source_position, near_distance) in enumerate(zip(self.source_positions, near_distances)):
+            low_cells = numpy.clip(numpy.floor((source_position - near_distance - self.lower_corner) /
+                                               self.cell_size).astype(numpy.int64), 0, cells_per_side)
+            high_cells = numpy.clip(numpy.floor((source_position + near_distance - self.lower_corner) /
+                                                self.cell_size).astype(numpy.int64) + 1, 0, cells_per_side)
+            if numpy.any(high_cells <= low_cells):
+                continue
+            cells = numpy.stack(numpy.meshgrid(*[numpy.arange(low, high) for low, high in zip(low_cells, high_cells)],
+                                               indexing='ij'), axis=-1).reshape(-1, 3)
+            cell_centers = self.lower_corner + (cells + .5) * self.cell_size
+            near = (numpy.linalg.norm(cell_centers - source_position, axis=1) - .5 * cell_diagonal < near_distance)
+            near_cells.append(numpy.ravel_multi_index(cells[near].T, (cells_per_side,) * 3))
+            near_sources.append(numpy.full(numpy.count_nonzero(near), source, dtype=numpy.int64))
+
+        near_cells = numpy.concatenate(near_cells)
+        order = numpy.argsort(near_cells, kind='mergesort')
+        self.near_sources = numpy.concatenate(near_sources)[order]
+        self.near_source_starts = numpy.searchsorted(near_cells[order], numpy.arange(cells_per_side**3 + 1))
+
+    def calculate_accelerations(self, positions):
+        accelerations = numpy.empty((len(positions), 3))
+
+        cell_coordinates = (positions - self.lower_corner) / self.cell_size
+        cells = numpy.floor(cell_coordinates).astype(numpy.int64)
+        inside_grid = numpy.all((cells >= 0) & (cells < self.cells_per_side), axis=1)
+        if not inside_grid.all():
+            accelerations[~inside_grid] = self.exact_accelerations(positions[~inside_grid])
+
+        positions = positions[inside_grid]
+        cells = cells[inside_grid]
+        weights = cell_coordinates[inside_grid] - cells
+        cell_numbers = numpy.ravel_multi_index(cells.T, (self.cells_per_side,) * 3)
+        interpolated_accelerations = numpy.zeros((len(cells), 3))
+        for corner_number, corner in enumerate(numpy.ndindex(2, 2, 2)):
+            corner_weights = numpy.prod(numpy.where(corner, weights, 1. - weights), axis=1)
+            interpolated_accelerations += corner_weights[:, numpy.newaxis] * self.far_fields[cell_numbers, corner_number]
+
+        rows, near_locations = expand_ranges(self.near_source_starts[cell_numbers],
+                                             self.near_source_starts[cell_numbers + 1])
+        if len(rows):
+            sources = self.near_sources[near_locations]
+            near_accelerations = calculate_pairwise_accelerations(positions[rows], self.source_positions[sources],
+                                                                  self.source_masses[sources])
+            for dimension_index in xrange(3):
+                interpolated_accelerations[:, dimension_index] += numpy.bincount(
+                    rows, near_accelerations[:, dimension_index], minlength=len(cells))
+
+        accelerations[inside_grid] = interpolated_accelerations
+        return accelerations
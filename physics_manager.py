@@ -1,57 +1,249 @@
-from operator import itemgetter
 import numpy
 
+from barnes_hut_octree import BarnesHutOctree
+from contact_islands import ContactIslandResolver
+from domain_decomposition import DomainDecomposition, DomainDecomposedBroadphase
+from broadphase import make_pair_code, split_pair_codes, choose_cell_size, find_overlapping_boxes_in_cells, \
+    SweepAndPruneBroadphase, SpatialHashBroadphase
+from gravity_field_cache import CachedGravityField
+from spatial_queries import SphereTree
+from step_profiler import StepProfiler, null_profiler
+
 
 __author__ = 'Jacob'
 
 
+# The time step and coefficient of restitution new worlds start with, and the ones default_world uses.
 dt = 1/60.
 e = .7
+# Roughly how many body/source pairs the gravity pass works on at once.
+gravity_chunk_size = 2**16
+
+
+class SpaceObjectArrays:
+    # Holds the state of every SpaceObject as rows of contiguous arrays, so the physics can be run
+    # as whole-array operations instead of looping over the objects one at a time.
+    # previous_positions are where the objects were at the start of the step, before they were moved.
+    # sleeping_constant_forces are what the constant forces were when the object fell asleep.
+    # synced_positions are where the change feed last reported the objects to be, see World.collect_changes().
+    # scheduled, level_of_detail_tiers and time_since_update are for World.use_level_of_detail().
+    # moved_by_hand is set when an object's position or radius is set from outside the step, see
+    # CollisionDetectorAndResolver.detect_all_collisions().
+    vector_array_names = ('positions', 'previous_positions', 'velocities', 'accelerations', 'sums_of_forces',
+                          'constant_forces', 'sleeping_constant_forces', 'synced_positions')
+    scalar_array_names_and_types = (('radii', float), ('masses', float), ('movable', bool),
+                                    ('effected_by_gravity', bool), ('gravity_source', bool),
+                                    ('colliding_with_gravity_source', bool), ('influenced_by_non_gravity_source', bool),
+                                    ('awake', bool), ('steps_at_rest', int), ('identifiers', numpy.int64),
+                                    ('scheduled', bool), ('level_of_detail_tiers', int), ('time_since_update', float),
+                                    ('moved_by_hand', bool))
+
+    def __init__(self, initial_capacity=16):
+        self.number_of_objects = 0
+        self.capacity = 0
+        self.space_objects = []
+        # Objects move to other rows when objects are removed, so each one also gets an identifier that never changes.
+        self.next_identifier = 0
+        # Index arrays of the rows having some set of flags, rebuilt only when objects or their flags change.
+        self.cached_indices = {}
+        # Makes every array, given its shape and type. See use_array_allocator().
+        self.allocate_array = numpy.zeros
+
+        for array_name in self.vector_array_names:
+            setattr(self, array_name, numpy.zeros((0, 3)))
+        for array_name, array_type in self.scalar_array_names_and_types:
+            setattr(self, array_name, numpy.zeros(0, dtype=array_type))
+
+        self.grow(initial_capacity)
+
+    def grow(self, minimum_capacity):
+        # The capacity is doubled so adding objects one at a time stays amortized constant time.
+        self.reallocate(max(minimum_capacity, 2 * self.capacity))
+
+    def reallocate(self, new_capacity):
+        number_of_objects = self.number_of_objects
+
+        for array_name in self.vector_array_names:
+            new_array = self.allocate_array((new_capacity, 3), float)
+            new_array[:number_of_objects] = getattr(self, array_name)[:number_of_objects]
+            setattr(self, array_name, new_array)
+        for array_name, array_type in self.scalar_array_names_and_types:
+            new_array = self.allocate_array(new_capacity, array_type)
+            new_array[:number_of_objects] = getattr(self, array_name)[:number_of_objects]
+            setattr(self, array_name, new_array)
+
+        self.capacity = new_capacity
+
+    def use_array_allocator(self, allocate_array):
+        # Moves every array into a new one made by allocate_array(shape, type), e.g. in memory shared with worker
+        # processes, and makes the arrays that way from now on.
+        self.allocate_array = allocate_array
+        self.reallocate(self.capacity)
+
+    def add_space_object(self, space_object, position, velocity, radius, mass,
+                         movable, effected_by_gravity, gravity_source):
+        return self.add_space_objects([space_object], position, velocity, radius, mass,
+                                      movable, effected_by_gravity, gravity_source)[0]
+
+    def add_space_objects(self, space_objects, positions, velocities, radii, masses,
+                          movable, effected_by_gravity, gravity_source):
+        # Adds a row for each of the space_objects at once. The other arguments have one entry per object, or one
+        # for all of them. Returns the new rows' indices.
+        number_added = len(space_objects)
+        if self.number_of_objects + number_added > self.capacity:
+            self.grow(self.number_of_objects + number_added)
+
+        rows = slice(self.number_of_objects, self.number_of_objects + number_added)
+        self.positions[rows] = numpy.reshape(positions, (-1, 3))
+        self.previous_positions[rows] = self.positions[rows]
+        # New objects haven't been reported anywhere yet.
+        self.synced_positions[rows] = numpy.inf
+        self.velocities[rows] = numpy.reshape(velocities, (-1, 3))
+        self.accelerations[rows] = 0.
+        self.sums_of_forces[rows] = 0.
+        self.constant_forces[rows] = 0.
+        self.radii[rows] = radii
+        self.masses[rows] = masses
+        self.movable[rows] = movable
+        self.effected_by_gravity[rows] = effected_by_gravity
+        self.gravity_source[rows] = gravity_source
+        self.colliding_with_gravity_source[rows] = False
+        self.influenced_by_non_gravity_source[rows] = False
+        self.awake[rows] = True
+        self.steps_at_rest[rows] = 0
+        self.scheduled[rows] = True
+        self.moved_by_hand[rows] = False
+        self.level_of_detail_tiers[rows] = 0
+        self.time_since_update[rows] = 0.
+        self.identifiers[rows] = numpy.arange(self.next_identifier, self.next_identifier + number_added)
+
+        self.space_objects.extend(space_objects)
+        self.next_identifier += number_added
+        self.number_of_objects += number_added
+        self.cached_indices.clear()
+        return numpy.arange(rows.start, rows.stop)
+
+    def remove_space_object(self, index):
+        # The last row is moved into the removed one's place, so nothing else has to shift. Returns where the moved
+        # row was, which is index itself if the last row was the one removed.
+        last_index = self.number_of_objects - 1
+        for array_name in self.vector_array_names:
+            getattr(self, array_name)[index] = getattr(self, array_name)[last_index]
+        for array_name, array_type in self.scalar_array_names_and_types:
+            getattr(self, array_name)[index] = getattr(self, array_name)[last_index]
+
+        moved_space_object = self.space_objects.pop()
+        if index != last_index:
+            self.space_objects[index] = moved_space_object
+            moved_space_object.index = index
+
+        self.number_of_objects -= 1
+        self.cached_indices.clear()
+        return last_index
+
+    def indices_of(self, *flag_array_names):
+        # Returns the indices of the objects that have all of the given flags set.
+        if flag_array_names not in self.cached_indices:
+            flags = numpy.ones(self.number_of_objects, dtype=bool)
+            for flag_array_name in flag_array_names:
+                flags &= getattr(self, flag_array_name)[:self.number_of_objects]
+            self.cached_indices[flag_array_names] = numpy.flatnonzero(flags)
+        return self.cached_indices[flag_array_names]
+
+
+class SwapRemoveList(list):
+    # A list whose remove() takes constant time, by moving the last item into the removed item's place, so the order
+    # of the items changes whenever one is removed. Items are only to be added with append() and extend().
+    def __init__(self):
+        list.__init__(self)
+        self.item_positions = {}
+
+    def append(self, item):
+        self.item_positions[item] = len(self)
+        list.append(self, item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def __contains__(self, item):
+        return item in self.item_positions
+
+    def remove(self, item):
+        position = self.item_positions.pop(item)
+        last_item = list.pop(self)
+        if last_item is not item:
+            self[position] = last_item
+            self.item_positions[last_item] = position
+
+
+def row_property(array_name, moves_object=False):
+    # The row is handed out as a (3,1) view, which is the shape SpaceObjects have always used.
+    def get_row(space_object):
+        return getattr(space_object.arrays, array_name)[space_object.index].reshape(3, 1)
+
+    def set_row(space_object, value):
+        getattr(space_object.arrays, array_name)[space_object.index] = numpy.ravel(value)
+        if moves_object:
+            space_object.world.query_tree = None
+            space_object.arrays.moved_by_hand[space_object.index] = True
+
+    return property(get_row, set_row)
+
+
+def element_property(array_name, element_type, changes_object_groups=False, moves_object=False):
+    def get_element(space_object):
+        return element_type(getattr(space_object.arrays, array_name)[space_object.index])
+
+    def set_element(space_object, value):
+        getattr(space_object.arrays, array_name)[space_object.index] = value
+        if changes_object_groups:
+            space_object.arrays.cached_indices.clear()
+        if moves_object:
+            space_object.world.query_tree = None
+            space_object.arrays.moved_by_hand[space_object.index] = True
+
+    return property(get_element, set_element)
+
+
+class SpaceObject(object):
+    # A lightweight handle on one row of its world's SpaceObjectArrays.
+    position = row_property('positions', moves_object=True)
+    velocity = row_property('velocities')
+    acceleration = row_property('accelerations')
+    sum_of_forces = row_property('sums_of_forces')
+    constant_forces = row_property('constant_forces')
+    radius = element_property('radii', float, moves_object=True)
+    mass = element_property('masses', float)
+    movable = element_property('movable', bool, changes_object_groups=True)
+    effected_by_gravity = element_property('effected_by_gravity', bool, changes_object_groups=True)
+    gravity_source = element_property('gravity_source', bool, changes_object_groups=True)
+    colliding_with_gravity_source = element_property('colliding_with_gravity_source', bool)
+    influenced_by_non_gravity_source = element_property('influenced_by_non_gravity_source', bool)
+    awake = element_property('awake', bool, changes_object_groups=True)
+    identifier = element_property('identifiers', int)
 
-
-all_objects = []
-movable_objects = []
-objects_effected_by_gravity = []
-gravity_sources = []
-
-
-class SpaceObject:
     def __init__(self, position, velocity, radius=0., mass=1.,
-                 movable=True, effected_by_gravity=True, gravity_source=False):
-
-        self.position = position
-        self.velocity = velocity
-        self.sum_of_forces = numpy.array([[0.], [0.], [0.]])
-        self.radius = numpy.abs(radius)
-        self.mass = mass
-        self.movable = movable
-        self.effected_by_gravity = effected_by_gravity
-        self.gravity_source = gravity_source
-        self.colliding_with_gravity_source = False
-        self.influenced_by_non_gravity_source = False
-        self.acceleration = numpy.array([[0.], [0.], [0.]])
-        self.constant_forces = numpy.array([[0.], [0.], [0.]])
+                 movable=True, effected_by_gravity=True, gravity_source=False, world=None):
 
-        all_objects.append(self)
+        if gravity_source:
+            movable = False
+            effected_by_gravity = False
 
-        if self.gravity_source:
-            self.movable = False
-            self.effected_by_gravity = False
-            gravity_sources.append(self)
+        self.world = world or default_world
+        self.arrays = self.world.space_object_arrays
+        self.index = self.arrays.add_space_object(self, position, velocity, numpy.abs(radius), mass,
+                                                  movable, effected_by_gravity, gravity_source)
+        self.world.add_to_object_lists([self])
 
-        if self.movable:
-            movable_objects.append(self)
-        
-        if self.effected_by_gravity:
-            objects_effected_by_gravity.append(self)
-
-        collision_detector_and_resolver.add_object_to_max_and_min_lists(self)
-
-    def move(self):
+    def move(self, time_step=None):
+        dt = time_step or self.world.dt
+        self.arrays.previous_positions[self.index] = self.arrays.positions[self.index]
         # Uses Velocity Verlet integration method
         self.position = self.position + self.velocity * dt + .5 * self.acceleration * dt * dt
 
-    def calculate_velocity(self):
+    def calculate_velocity(self, time_step=None):
+        dt, e = time_step or self.world.dt, self.world.e
         previous_speed = numpy.linalg.norm(self.velocity)
 
         self.velocity = self.velocity + .5 * self.acceleration * dt
@@ -59,7 +251,7 @@ class SpaceObject:
         self.velocity = self.velocity + .5 * self.acceleration * dt
         self.sum_of_forces = self.constant_forces
         if self.effected_by_gravity:
-            self.sum_of_forces = self.sum_of_forces + calculate_all_gravitational_forces(self)
+            self.sum_of_forces = self.sum_of_forces + self.world.calculate_all_gravitational_forces(self)
         self.acceleration = self.sum_of_forces / self.mass
 
         self.velocity = self.velocity + .5 * self.acceleration * dt
@@ -75,230 +267,965 @@ class SpaceObject:
         self.influenced_by_non_gravity_source = False
 
 
-def calculate_all_gravitational_forces(space_object):
-    def calculate_gravitational_force(space_object1, space_object2):
-        distance_vector = space_object1.position - space_object2.position
-        distance_direction = distance_vector / numpy.linalg.norm(distance_vector)
-        distance_magnitude_squared = numpy.dot(numpy.transpose(distance_vector), distance_vector)
-        mass_times_mass = space_object1.mass * space_object2.mass
-        individual_force = (mass_times_mass / distance_magnitude_squared) * distance_direction
-        return individual_force
+def calculate_gravitational_accelerations(target_positions, source_positions, source_masses):
+    # Sums the acceleration every source puts on every target. The target/source pairs are done in chunks of
+    # about gravity_chunk_size so the temporary arrays stay the same size no matter how many sources there are.
+    accelerations = numpy.zeros((len(target_positions), 3))
+    if len(source_positions) == 0:
+        return accelerations
 
-    force = numpy.array([[0.], [0.], [0.]])
-    for gravity_source in gravity_sources:
-        force = calculate_gravitational_force(gravity_source, space_object)
+    sources_per_chunk = min(len(source_positions), gravity_chunk_size)
+    targets_per_chunk = max(1, gravity_chunk_size // sources_per_chunk)
 
-    return force
+    for target_start in xrange(0, len(target_positions), targets_per_chunk):
+        target_chunk = slice(target_start, target_start + targets_per_chunk)
 
+        for source_start in xrange(0, len(source_positions), sources_per_chunk):
+            source_chunk = slice(source_start, source_start + sources_per_chunk)
 
-def move_all_movable_objects():
-    for space_object in movable_objects:
-        space_object.move()
+            distance_vectors = source_positions[numpy.newaxis, source_chunk] - target_positions[target_chunk, numpy.newaxis]
+            distances_squared = numpy.sum(distance_vectors * distance_vectors, axis=2)
+            # A target sitting exactly on a source has no direction to be pulled in.
+            distances_squared[distances_squared == 0.] = numpy.inf
+            mass_over_distance_cubed = source_masses[source_chunk] / (distances_squared * numpy.sqrt(distances_squared))
+            accelerations[target_chunk] += numpy.einsum('ts,tsd->td', mass_over_distance_cubed, distance_vectors)
 
+    return accelerations
 
-def calculate_all_velocities():
-    for space_object in movable_objects:
-        space_object.calculate_velocity()
 
+def calculate_nearest_distances(target_positions, source_positions):
+    # The distance from every target to the closest source, chunked the same way as the gravity.
+    nearest_distances = numpy.full(len(target_positions), numpy.inf)
+    if len(source_positions) == 0:
+        return nearest_distances
 
-class DetectAndResolveAllCollisions:
-    def __init__(self):
-        # Used for the grid collision detection method. Keeps track of how far along each dimension each object stretches.
-        self.maxes_and_mins_along_dimensions = ([], [], [])
-        self.colliding_pairs = []
-
-    def add_object_to_max_and_min_lists(self, object_to_be_added):
-        for dimension_index in xrange(len(self.maxes_and_mins_along_dimensions)):
-            dimension = self.maxes_and_mins_along_dimensions[dimension_index]
-            # The additional .01 is so the collision detector will pick up objects that are just barely touching.
-            object_max = object_to_be_added.position[dimension_index] + object_to_be_added.radius + .005
-            object_min = object_to_be_added.position[dimension_index] - object_to_be_added.radius - .005
-            dimension.append([object_to_be_added, object_max])
-            dimension.append([object_to_be_added, object_min])
-            dimension.sort(key=itemgetter(1))
-
-    def detect_all_collisions(self):
+    sources_per_chunk = min(len(source_positions), gravity_chunk_size)
+    targets_per_chunk = max(1, gravity_chunk_size // sources_per_chunk)
 
-        def update_all_maxes_and_mins(objects_to_be_updated=all_objects):
+    for target_start in xrange(0, len(target_positions), targets_per_chunk):
+        target_chunk = slice(target_start, target_start + targets_per_chunk)
 
-            def update_object_in_dimension(current_dimension_index, space_object):
-                dimension = self.maxes_and_mins_along_dimensions[current_dimension_index]
+        for source_start in xrange(0, len(source_positions), sources_per_chunk):
+            source_chunk = slice(source_start, source_start + sources_per_chunk)
 
-                updating_max = True
+            distance_vectors = source_positions[numpy.newaxis, source_chunk] - target_positions[target_chunk, numpy.newaxis]
+            distances_squared = numpy.sum(distance_vectors * distance_vectors, axis=2)
+            nearest_distances[target_chunk] = numpy.minimum(nearest_distances[target_chunk],
+                                                            numpy.sqrt(distances_squared.min(axis=1)))
 
-                for object_number_pair in dimension:
-                    object_to_compare_against = object_number_pair[0]
+    return nearest_distances
 
-                    if space_object == object_to_compare_against:
-                        if updating_max:
-                            # The additional .01 is so the collision detector will pick up objects that are just barely touching.
-                            object_number_pair[1] = space_object.position[current_dimension_index] + space_object.radius + .005
-                            updating_max = False
-                        else:
-                            object_number_pair[1] = space_object.position[current_dimension_index] - space_object.radius - .005
-                            break
 
-            for dimension_index in xrange(len(self.maxes_and_mins_along_dimensions)):
-                for space_object in objects_to_be_updated:
-                    update_object_in_dimension(dimension_index, space_object)
-
-                # Sorts the dimension based on the max and min values.
-                self.maxes_and_mins_along_dimensions[dimension_index].sort(key=itemgetter(1))
-
-        def collision_detection_grid_method():
-
-            def checking_single_dimension(dimension):
-                potentially_colliding_pairs_in_one_dimension = []
-                current_set_of_potentially_colliding_objects = set()
-
-                for object_number_pair in dimension:
-                    space_object = object_number_pair[0]
-
-                    if space_object in current_set_of_potentially_colliding_objects:
-                        current_set_of_potentially_colliding_objects.remove(space_object)
-                        for potentially_colliding_object in current_set_of_potentially_colliding_objects:
-                            # To make sure the objects in the pairs are in the same order every time they are listed
-                            # as potentially colliding:
-                            if space_object > potentially_colliding_object:
-                                potentially_colliding_pairs_in_one_dimension.append((space_object, potentially_colliding_object))
-                            else:
-                                potentially_colliding_pairs_in_one_dimension.append((potentially_colliding_object, space_object))
-                    else:
-                        current_set_of_potentially_colliding_objects.add(space_object)
-
-                return potentially_colliding_pairs_in_one_dimension
-
-            potentially_colliding_pairs_in_0_dimension = checking_single_dimension(self.maxes_and_mins_along_dimensions[0])
-            potentially_colliding_pairs_in_1_dimension = checking_single_dimension(self.maxes_and_mins_along_dimensions[1])
-            potentially_colliding_pairs_in_2_dimension = checking_single_dimension(self.maxes_and_mins_along_dimensions[2])
-
-            potentially_colliding_pairs = []
-
-            for potentially_colliding_pair in potentially_colliding_pairs_in_0_dimension:
-                if (potentially_colliding_pair in potentially_colliding_pairs_in_1_dimension and
-                        potentially_colliding_pair in potentially_colliding_pairs_in_2_dimension):
-
-                    potentially_colliding_pairs.append(potentially_colliding_pair)
-
-            return potentially_colliding_pairs
-
-        def distance_pair_intersecting(space_object0, space_object1):
-            distance_intersecting = -1
-            if space_object0.radius != 0 or space_object1.radius != 0:
-                vector_between_centers = space_object0.position - space_object1.position
-                distance_between_centers = numpy.linalg.norm(vector_between_centers)
-                if distance_between_centers <= space_object0.radius + space_object1.radius:
-                    distance_intersecting = (space_object0.radius + space_object1.radius) - distance_between_centers
-            return distance_intersecting
+class DetectAndResolveAllCollisions:
+    def __init__(self, world, broadphase_class=None):
+        self.world = world
+        self.arrays = world.space_object_arrays
+        self.broadphase = (broadphase_class or SweepAndPruneBroadphase)(self.arrays)
+        self.colliding_pairs = (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+        # Contacts are split into islands that don't affect each other; see resolve_islands_in_parallel().
+        self.island_resolver = ContactIslandResolver()
+        # The penetration back-off gives up after this many passes over the intersecting pairs.
+        self.maximum_back_off_iterations = 32
+        # See use_continuous_collision_detection().
+        self.continuous_collision_detection = False
+        # What the last step found, e.g. how many passes the back-off took.
+        self.step_report = {}
+        # The identifiers of the pairs the last step resolved, which stay right even if rows move afterwards.
+        self.last_contacts = (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+
+    def use_broadphase(self, broadphase_class, **broadphase_options):
+        # Swaps in a different way of finding potentially colliding pairs, e.g. SpatialHashBroadphase for scenes where
+        # lots of objects line up along one axis.
+        self.broadphase = broadphase_class(self.arrays, **broadphase_options)
+        self.broadphase.swept_volumes = self.continuous_collision_detection
+
+    def use_continuous_collision_detection(self, enabled=True):
+        # Finds collisions anywhere along the objects' paths over the step instead of only where they end up, so fast
+        # objects can't pass through each other and don't end up deep inside each other. The broadphase uses the
+        # volumes the objects swept through, and each pair that met during the step is moved back to where it first
+        # touched before the usual back-off runs.
+        self.continuous_collision_detection = enabled
+        self.broadphase.swept_volumes = enabled
+        self.broadphase.objects_changed()
+
+    def add_object_to_max_and_min_lists(self, objects_to_be_added):
+        self.broadphase.objects_changed()
 
-        def move_colliding_pair_back(space_object0, space_object1):
+    def detect_all_collisions(self):
+        # Works on all of the potentially colliding pairs at once: finds how far each pair is intersecting, moves the
+        # pairs that are too far in back along their velocities, and repeats until nothing is intersecting by .01 or
+        # more, or maximum_back_off_iterations is reached. Pairs that are just touching are kept for the impulses.
+        arrays = self.arrays
+
+        def distance_pairs_intersecting(first_objects, second_objects):
+            radii_sums = arrays.radii[first_objects] + arrays.radii[second_objects]
+            vectors_between_centers = arrays.positions[first_objects] - arrays.positions[second_objects]
+            distances_between_centers = numpy.sqrt(numpy.sum(vectors_between_centers * vectors_between_centers, axis=1))
+            intersecting = (radii_sums != 0) & (distances_between_centers <= radii_sums)
+            return numpy.where(intersecting, radii_sums - distances_between_centers, -1.)
+
+        def move_colliding_pairs_back(first_objects, second_objects):
             # Uses the quadratic formula to find the amount of time needed to move the objects back
             # so they are just barely touching, aka
             # radius + radius = magnitude(difference in positions + difference in velocity * time)
             # and we are solving for time.
 
-            space_object0_velocity = space_object0.velocity
-            space_object1_velocity = space_object1.velocity
-
-            vector_between_centers = space_object0.position - space_object1.position
-
-            if space_object0.movable and not space_object1.movable:
-                space_object1_velocity = numpy.array([[0.], [0.], [0.]])
-                if numpy.array_equal(space_object0_velocity, numpy.array([[0.], [0.], [0.]])):
-                    space_object0_velocity = -1. * vector_between_centers
-            elif space_object1.movable and not space_object0.movable:
-                space_object0_velocity = numpy.array([[0.], [0.], [0.]])
-                if numpy.array_equal(space_object1_velocity, numpy.array([[0.], [0.], [0.]])):
-                    space_object1_velocity = vector_between_centers
-
-            vector_velocity_difference = space_object0_velocity - space_object1_velocity
-
-            if not numpy.array_equal(vector_velocity_difference, numpy.array([[0.], [0.], [0.]])):
-                a = numpy.dot(numpy.transpose(vector_velocity_difference), vector_velocity_difference)
-                b = 2. * numpy.dot(numpy.transpose(vector_between_centers), vector_velocity_difference)
-                # Mathematically, it could be "+ (space_object1.radius + space_object2.radius)" instead of "-",
-                # but the "+" will lead to the time being a complex number.
-                c = numpy.dot(numpy.transpose(vector_between_centers), vector_between_centers) - (space_object0.radius + space_object1.radius)**2
-
-                # The quadratic formula has a "+ or -" in it, but we always want a negative time, so we use the "-".
-                time = (-1.*b - (b**2. - 4.*a*c)**(1./2.))/(2.*a)
-
-                space_object0.position = space_object0.position + (time * space_object0_velocity)
-                space_object1.position = space_object1.position + (time * space_object1_velocity)
-                update_all_maxes_and_mins([space_object0, space_object1])
-
-        current_max_distance_intersecting = 1
-
-        while current_max_distance_intersecting >= .01:
-
-            current_max_distance_intersecting = -1
-
-            update_all_maxes_and_mins()
-            potentially_colliding_pairs = collision_detection_grid_method()
-
-            if not potentially_colliding_pairs:
+            first_velocities = arrays.velocities[first_objects]
+            second_velocities = arrays.velocities[second_objects]
+
+            vectors_between_centers = arrays.positions[first_objects] - arrays.positions[second_objects]
+
+            # An object pushed back off something immovable goes straight out from it if it isn't moving.
+            only_first_movable = arrays.movable[first_objects] & ~arrays.movable[second_objects]
+            second_velocities[only_first_movable] = 0.
+            first_standing_still = only_first_movable & numpy.all(first_velocities == 0., axis=1)
+            first_velocities[first_standing_still] = -1. * vectors_between_centers[first_standing_still]
+
+            only_second_movable = arrays.movable[second_objects] & ~arrays.movable[first_objects]
+            first_velocities[only_second_movable] = 0.
+            second_standing_still = only_second_movable & numpy.all(second_velocities == 0., axis=1)
+            second_velocities[second_standing_still] = vectors_between_centers[second_standing_still]
+
+            velocity_differences = first_velocities - second_velocities
+
+            a = numpy.sum(velocity_differences * velocity_differences, axis=1)
+            b = 2. * numpy.sum(vectors_between_centers * velocity_differences, axis=1)
+            # Mathematically, it could be "+ (space_object1.radius + space_object2.radius)" instead of "-",
+            # but the "+" will lead to the time being a complex number.
+            c = (numpy.sum(vectors_between_centers * vectors_between_centers, axis=1) -
+                 (arrays.radii[first_objects] + arrays.radii[second_objects])**2)
+
+            solvable = (a != 0.) & (b**2. - 4.*a*c >= 0.)
+            if not solvable.any():
+                return numpy.zeros(0, dtype=numpy.int64)
+            a, b, c = a[solvable], b[solvable], c[solvable]
+            # The quadratic formula has a "+ or -" in it, but we always want a negative time, so we use the "-".
+            times = (-1.*b - (b**2. - 4.*a*c)**(1./2.))/(2.*a)
+
+            # An object in more than one of these pairs is only moved back for the pair that needs the most time,
+            # and anything left over gets picked up on the next pass.
+            moved_objects = numpy.concatenate([first_objects[solvable], second_objects[solvable]])
+            move_times = numpy.concatenate([times, times])
+            displacements = numpy.concatenate([first_velocities[solvable], second_velocities[solvable]]) * move_times[:, numpy.newaxis]
+            order = numpy.lexsort((move_times, moved_objects))
+            moved_objects, displacements = moved_objects[order], displacements[order]
+            first_for_object = numpy.concatenate([[True], moved_objects[1:] != moved_objects[:-1]])
+            moved_objects, displacements = moved_objects[first_for_object], displacements[first_for_object]
+
+            arrays.positions[moved_objects] = arrays.positions[moved_objects] + displacements
+            return moved_objects
+
+        def move_pairs_back_to_times_of_impact(first_objects, second_objects):
+            # Takes the objects as moving in straight lines from their previous positions to their current ones over
+            # the step, and solves
+            # radius + radius = magnitude(difference in previous positions + difference in movement * time)
+            # for the first time, from 0 to 1, that each pair touched.
+            def movements(objects):
+                # Immovable objects count as staying put, even if they were put somewhere new by hand.
+                return ((arrays.positions[objects] - arrays.previous_positions[objects]) *
+                        arrays.movable[objects, numpy.newaxis])
+
+            # Worked out from where they are now, so an immovable object's start is where it is, not where it was
+            # last time previous_positions was set.
+            first_movements, second_movements = movements(first_objects), movements(second_objects)
+            start_vectors = ((arrays.positions[first_objects] - first_movements) -
+                             (arrays.positions[second_objects] - second_movements))
+            movement_differences = first_movements - second_movements
+            radii_sums = arrays.radii[first_objects] + arrays.radii[second_objects]
+
+            a = numpy.sum(movement_differences * movement_differences, axis=1)
+            b = 2. * numpy.sum(start_vectors * movement_differences, axis=1)
+            c = numpy.sum(start_vectors * start_vectors, axis=1) - radii_sums**2
+
+            # Pairs that were already touching at the start of the step are left to the back-off.
+            met = (radii_sums != 0) & (a != 0.) & (c > 0.) & (b**2. - 4.*a*c >= 0.)
+            if not met.any():
+                return numpy.zeros(0, dtype=numpy.int64)
+            a, b, c = a[met], b[met], c[met]
+            times = (-1.*b - (b**2. - 4.*a*c)**(1./2.))/(2.*a)
+            during_step = (times >= 0.) & (times < 1.)
+            if not during_step.any():
+                return numpy.zeros(0, dtype=numpy.int64)
+            first_objects, second_objects = first_objects[met][during_step], second_objects[met][during_step]
+            times = times[during_step]
+
+            # Every object goes back to the first impact it had, and anything it hits on the way back out is left to
+            # the back-off.
+            moved_objects = numpy.concatenate([first_objects, second_objects])
+            move_times = numpy.concatenate([times, times])
+            order = numpy.lexsort((move_times, moved_objects))
+            moved_objects, move_times = moved_objects[order], move_times[order]
+            first_for_object = numpy.concatenate([[True], moved_objects[1:] != moved_objects[:-1]])
+            first_for_object &= arrays.movable[moved_objects]
+            moved_objects, move_times = moved_objects[first_for_object], move_times[first_for_object]
+
+            arrays.positions[moved_objects] = (arrays.previous_positions[moved_objects] +
+                                               move_times[:, numpy.newaxis] * movements(moved_objects))
+            return moved_objects
+
+        def mark_touching_pairs(first_objects, second_objects):
+            first_is_gravity_source = arrays.gravity_source[first_objects]
+            second_is_gravity_source = arrays.gravity_source[second_objects]
+            arrays.colliding_with_gravity_source[second_objects[first_is_gravity_source]] = True
+            arrays.influenced_by_non_gravity_source[second_objects[~first_is_gravity_source]] = True
+            arrays.colliding_with_gravity_source[first_objects[second_is_gravity_source]] = True
+            arrays.influenced_by_non_gravity_source[first_objects[~second_is_gravity_source]] = True
+
+        touching_pair_codes = [numpy.zeros(0, dtype=numpy.int64)]
+        number_of_potentially_colliding_pairs = None
+        back_off_iterations = 0
+
+        profiler = self.world.profiler
+        sleeping_enabled = self.world.sleeping_enabled
+        level_of_detail_enabled = self.world.level_of_detail_enabled
+        awake_and_movable = arrays.movable & arrays.awake
+
+        def find_potentially_colliding_pairs():
+            first_objects, second_objects = profiler.time_phase('broadphase', self.broadphase.potentially_colliding_pairs)
+            if not sleeping_enabled:
+                return first_objects, second_objects
+            # Nothing happens between objects that are asleep or can't move.
+            involves_awake_object = awake_and_movable[first_objects] | awake_and_movable[second_objects]
+            return first_objects[involves_awake_object], second_objects[involves_awake_object]
+
+        number_of_objects = arrays.number_of_objects
+        if sleeping_enabled or level_of_detail_enabled:
+            # Objects that are asleep or weren't scheduled haven't moved, so their boxes don't have to be looked at
+            # again unless they were moved or resized by hand. Immovable objects are few, and their boxes are always
+            # looked at again, since they can also be moved by writing to the arrays directly.
+            movable = arrays.movable[:number_of_objects]
+            needs_new_box = ((movable & arrays.awake[:number_of_objects] & arrays.scheduled[:number_of_objects]) |
+                             ~movable | arrays.moved_by_hand[:number_of_objects])
+            profiler.time_phase('broadphase', self.broadphase.update, numpy.flatnonzero(needs_new_box))
+        else:
+            profiler.time_phase('broadphase', self.broadphase.update)
+        arrays.moved_by_hand[:number_of_objects] = False
+
+        if self.continuous_collision_detection:
+            first_objects, second_objects = find_potentially_colliding_pairs()
+            moved_objects = move_pairs_back_to_times_of_impact(first_objects, second_objects)
+            profiler.time_phase('broadphase', self.broadphase.update, moved_objects)
+            self.step_report['time_of_impact_objects'] = len(moved_objects)
+
+        while True:
+            first_objects, second_objects = find_potentially_colliding_pairs()
+            if number_of_potentially_colliding_pairs is None:
+                number_of_potentially_colliding_pairs = len(first_objects)
+
+            distances_intersecting = distance_pairs_intersecting(first_objects, second_objects)
+            touching = (distances_intersecting >= -.001) & (distances_intersecting < .01)
+            too_far_in = distances_intersecting >= .01
+
+            if back_off_iterations == self.maximum_back_off_iterations:
+                # Out of passes, so the pairs still too far in are left to the impulses to push apart.
+                touching |= too_far_in
+
+            mark_touching_pairs(first_objects[touching], second_objects[touching])
+            touching_pair_codes.append(make_pair_code(first_objects[touching], second_objects[touching]))
+
+            if not too_far_in.any() or back_off_iterations == self.maximum_back_off_iterations:
                 break
 
-            for pair in potentially_colliding_pairs:
-                space_object0, space_object1 = pair
-
-                distance_intersecting = distance_pair_intersecting(space_object0, space_object1)
-
-                if distance_intersecting >= current_max_distance_intersecting:
-                    current_max_distance_intersecting = distance_intersecting
+            back_off_iterations += 1
+            moved_objects = move_colliding_pairs_back(first_objects[too_far_in], second_objects[too_far_in])
+            # Only the objects that get moved back have to be updated again on later passes.
+            profiler.time_phase('broadphase', self.broadphase.update, moved_objects)
 
-                if distance_intersecting >= .01:
-                    move_colliding_pair_back(space_object0, space_object1)
-                elif distance_intersecting >= -.001:
-                    if space_object0.gravity_source:
-                        space_object1.colliding_with_gravity_source = True
-                    else:
-                        space_object1.influenced_by_non_gravity_source = True
-                    if space_object1.gravity_source:
-                        space_object0.colliding_with_gravity_source = True
-                    else:
-                        space_object0.influenced_by_non_gravity_source = True
+        self.colliding_pairs = split_pair_codes(numpy.unique(numpy.concatenate(touching_pair_codes)))
 
-                    self.colliding_pairs.append((space_object0, space_object1))
+        self.step_report['potentially_colliding_pairs'] = number_of_potentially_colliding_pairs
+        self.step_report['colliding_pairs'] = len(self.colliding_pairs[0])
+        self.step_report['back_off_iterations'] = back_off_iterations
 
     def resolve_all_collisions(self):
-        def apply_impulse(space_object0, space_object1):
-
-            contact_normal_not_unit = space_object0.position - space_object1.position
-            contact_normal = contact_normal_not_unit / numpy.linalg.norm(contact_normal_not_unit)
-            object0_relative_velocity = numpy.dot(numpy.transpose(space_object0.velocity), contact_normal) * contact_normal
-            object1_relative_velocity = numpy.dot(numpy.transpose(space_object1.velocity), contact_normal) * contact_normal
-
-            vector_velocity_difference = object0_relative_velocity - object1_relative_velocity
-
-            if numpy.dot(numpy.transpose(vector_velocity_difference), contact_normal) >= 0:
-                pass
-
-            elif space_object0.movable and space_object1.movable:
-
-                impulse = (1 + e) * vector_velocity_difference * ((space_object0.mass * space_object1.mass) / (space_object0.mass + space_object1.mass))
-
-                space_object0.velocity -= impulse/space_object0.mass
-                space_object1.velocity += impulse/space_object1.mass
-
-            elif space_object0.movable:
-                computed_velocity_before_e = -2*object0_relative_velocity + space_object0.velocity
-                space_object0.velocity = e * computed_velocity_before_e
-
-            elif space_object1.movable:
-                computed_velocity_before_e = -2*object1_relative_velocity + space_object1.velocity
-                space_object1.velocity = e * computed_velocity_before_e
-
-        for pair in self.colliding_pairs:
-            space_object0, space_object1 = pair
-            apply_impulse(space_object0, space_object1)
-            self.colliding_pairs = []
-
-collision_detector_and_resolver = DetectAndResolveAllCollisions()
-
-
-def go_forward_one_time_step():
-    move_all_movable_objects()
-    collision_detector_and_resolver.detect_all_collisions()
-    calculate_all_velocities()
-    collision_detector_and_resolver.resolve_all_collisions()
+        first_objects, second_objects = self.colliding_pairs
+        self.step_report.update(self.island_resolver.resolve(self.arrays, first_objects, second_objects, self.world.e))
+        self.last_contacts = (self.arrays.identifiers[first_objects], self.arrays.identifiers[second_objects])
+        self.colliding_pairs = (numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64))
+
+    def resolve_islands_in_parallel(self, worker_count=None, minimum_contacts_for_workers=2000):
+        # Contacts that share no movable objects are solved on a pool of worker_count processes (one per core by default)
+        # once a step has at least minimum_contacts_for_workers of them.
+        self.island_resolver.close()
+        self.island_resolver = ContactIslandResolver(worker_count, minimum_contacts_for_workers)
+
+
+
+class World:
+    # Everything one simulation needs: its objects, settings, and collision detector. Worlds share nothing, so any
+    # number of them can be stepped side by side, or in separate processes (see batch_runner.py).
+    def __init__(self, time_step=None, coefficient_of_restitution=None):
+        self.dt = dt if time_step is None else time_step
+        self.e = e if coefficient_of_restitution is None else coefficient_of_restitution
+
+        self.mutual_gravity = False
+        self.opening_angle = .5
+        self.softening_length = .1
+        # The sources' field is only sampled onto a grid if asked for, see use_cached_gravity_field().
+        self.cached_gravity_field_enabled = False
+        self.gravity_field_cells_per_side = 64
+        self.cached_gravity_field = None
+        self.cached_gravity_field_sources = None
+
+        self.space_object_arrays = SpaceObjectArrays()
+        self.all_objects = SwapRemoveList()
+        self.movable_objects = SwapRemoveList()
+        self.objects_effected_by_gravity = SwapRemoveList()
+        self.gravity_sources = SwapRemoveList()
+        self.collision_detector_and_resolver = DetectAndResolveAllCollisions(self)
+        # Stands in for a StepProfiler while profiling is off, see enable_profiling().
+        self.profiler = null_profiler
+
+        # How advance() splits up real time, see there.
+        self.maximum_steps_per_advance = 8
+        self.maximum_substeps = 8
+        self.substeps_per_orbit = 64
+        self.maximum_travel_per_substep = .5
+        self.unsimulated_time = 0.
+        self.positions_before_last_step = None
+        self.advance_report = {}
+
+        # See use_sleeping().
+        self.sleeping_enabled = False
+        self.sleep_speed = .1
+        self.steps_to_fall_asleep = 60
+        self.sleeping_sources_description = None
+
+        # See use_level_of_detail().
+        self.level_of_detail_enabled = False
+        self.level_of_detail_stopping = False
+        self.points_of_interest = None
+        self.tier_distances = (500., 2000.)
+        self.tier_step_intervals = (1, 4, 16)
+        self.isolation_distance = 20.
+        self.level_of_detail_report = {}
+
+        # See use_culling_bounds().
+        self.culling_bounds = None
+        self.culled_objects = []
+
+        # Called with the world at the end of every step, see add_step_listener().
+        self.step_listeners = []
+        self.steps_taken = 0
+        self.simulated_time = 0.
+
+        # See use_change_feed().
+        self.change_tolerance = None
+        self.removed_identifiers = []
+
+        # See spatial_queries(). Thrown away whenever objects move or are added or removed.
+        self.query_tree = None
+
+        # See use_domain_decomposition().
+        self.domain_decomposition = None
+
+    def add_space_object(self, position, velocity, radius=0., mass=1.,
+                         movable=True, effected_by_gravity=True, gravity_source=False):
+        return SpaceObject(position, velocity, radius, mass, movable, effected_by_gravity, gravity_source, world=self)
+
+    def create_space_objects(self, positions, velocities, radii=0., masses=1.,
+                             movable=True, effected_by_gravity=True, gravity_source=False):
+        # Makes a SpaceObject for every row of positions and velocities (n by 3) in one go, with the broadphase set
+        # up for all of them together. The other arguments can be one value for all of them or one per object.
+        positions = numpy.reshape(numpy.asarray(positions, dtype=float), (-1, 3))
+        number_of_objects = len(positions)
+        gravity_source = numpy.broadcast_to(gravity_source, number_of_objects)
+        movable = numpy.broadcast_to(movable, number_of_objects) & ~gravity_source
+        effected_by_gravity = numpy.broadcast_to(effected_by_gravity, number_of_objects) & ~gravity_source
+
+        space_objects = [SpaceObject.__new__(SpaceObject) for object_number in xrange(number_of_objects)]
+        indices = self.space_object_arrays.add_space_objects(space_objects, positions, velocities, numpy.abs(radii),
+                                                             masses, movable, effected_by_gravity, gravity_source)
+        for space_object, index in zip(space_objects, indices.tolist()):
+            space_object.world = self
+            space_object.arrays = self.space_object_arrays
+            space_object.index = index
+
+        self.add_to_object_lists(space_objects)
+        return space_objects
+
+    def add_to_object_lists(self, space_objects):
+        arrays = self.space_object_arrays
+        self.all_objects.extend(space_objects)
+        self.gravity_sources.extend(space_object for space_object in space_objects
+                                    if arrays.gravity_source[space_object.index])
+        self.movable_objects.extend(space_object for space_object in space_objects if arrays.movable[space_object.index])
+        self.objects_effected_by_gravity.extend(space_object for space_object in space_objects
+                                                if arrays.effected_by_gravity[space_object.index])
+        self.collision_detector_and_resolver.add_object_to_max_and_min_lists(space_objects)
+        self.query_tree = None
+
+    def remove_space_object(self, space_object):
+        # Takes the object out of the world in constant time. The object that was in the last row takes its row,
+        # so indices into the arrays change, but identifiers don't.
+        arrays = self.space_object_arrays
+        index = space_object.index
+        if self.change_tolerance is not None:
+            self.removed_identifiers.append(int(arrays.identifiers[index]))
+        moved_index = arrays.remove_space_object(index)
+        self.collision_detector_and_resolver.broadphase.object_removed(index, moved_index)
+        self.query_tree = None
+
+        if self.positions_before_last_step is not None:
+            stepped = len(self.positions_before_last_step)
+            if moved_index < stepped:
+                self.positions_before_last_step[index] = self.positions_before_last_step[moved_index]
+            elif index < stepped:
+                self.positions_before_last_step[index] = arrays.positions[index]
+            self.positions_before_last_step = self.positions_before_last_step[:min(stepped, arrays.number_of_objects)]
+
+        for object_list in (self.all_objects, self.gravity_sources, self.movable_objects,
+                            self.objects_effected_by_gravity):
+            if space_object in object_list:
+                object_list.remove(space_object)
+        space_object.index = None
+
+    def remove_space_objects(self, space_objects):
+        # Each removal takes constant time; the broadphase drops all their pairs in one go when it next needs them.
+        for space_object in space_objects:
+            self.remove_space_object(space_object)
+
+    def use_culling_bounds(self, lower_corner, upper_corner):
+        # Movable objects that end a step entirely outside the box from lower_corner to upper_corner are removed.
+        # The ones removed by the last step are kept in culled_objects.
+        self.culling_bounds = (numpy.ravel(lower_corner), numpy.ravel(upper_corner))
+
+    def stop_culling(self):
+        self.culling_bounds = None
+        self.culled_objects = []
+
+    def cull_objects_out_of_bounds(self):
+        arrays = self.space_object_arrays
+        lower_corner, upper_corner = self.culling_bounds
+        movable = arrays.indices_of('movable')
+        radii = arrays.radii[movable, numpy.newaxis]
+        outside = numpy.any((arrays.positions[movable] - radii > upper_corner) |
+                            (arrays.positions[movable] + radii < lower_corner), axis=1)
+        self.culled_objects = [arrays.space_objects[index] for index in movable[outside].tolist()]
+        self.remove_space_objects(self.culled_objects)
+
+    def calculate_all_gravitational_forces(self, space_object):
+        arrays = self.space_object_arrays
+        sources = arrays.indices_of('gravity_source')
+        acceleration = calculate_gravitational_accelerations(arrays.positions[[space_object.index]],
+                                                             arrays.positions[sources], arrays.masses[sources])
+        return space_object.mass * acceleration.reshape(3, 1)
+
+    def use_cached_gravity_field(self, cells_per_side=64):
+        self.cached_gravity_field_enabled = True
+        self.gravity_field_cells_per_side = cells_per_side
+        self.cached_gravity_field = None
+
+    def use_exact_gravity_field(self):
+        self.cached_gravity_field_enabled = False
+        self.cached_gravity_field = None
+
+    def update_cached_gravity_field(self):
+        # Samples the sources' field again if they've changed since it was last sampled. Returns the field, or None if
+        # there isn't one to use.
+        arrays = self.space_object_arrays
+        sources = arrays.indices_of('gravity_source')
+        if not self.cached_gravity_field_enabled or len(sources) == 0:
+            return None
+
+        source_positions = arrays.positions[sources]
+        source_masses = arrays.masses[sources]
+        sources_description = numpy.column_stack([source_positions, source_masses, arrays.radii[sources]])
+        if self.cached_gravity_field is None or not numpy.array_equal(sources_description, self.cached_gravity_field_sources):
+            def exact_accelerations(positions):
+                return calculate_gravitational_accelerations(positions, source_positions, source_masses)
+
+            self.cached_gravity_field = CachedGravityField(exact_accelerations, source_positions, source_masses,
+                                                           arrays.radii[sources], self.gravity_field_cells_per_side)
+            self.cached_gravity_field_sources = sources_description
+        return self.cached_gravity_field
+
+    def calculate_source_gravitational_accelerations(self, target_indices):
+        arrays = self.space_object_arrays
+        cached_gravity_field = self.update_cached_gravity_field()
+        if cached_gravity_field is not None:
+            return cached_gravity_field.calculate_accelerations(arrays.positions[target_indices])
+
+        sources = arrays.indices_of('gravity_source')
+        return calculate_gravitational_accelerations(arrays.positions[target_indices], arrays.positions[sources],
+                                                     arrays.masses[sources])
+
+    def use_mutual_gravity(self, new_opening_angle=.5, new_softening_length=.1):
+        self.mutual_gravity = True
+        self.opening_angle = new_opening_angle
+        self.softening_length = new_softening_length
+
+    def use_gravity_sources_only(self):
+        self.mutual_gravity = False
+
+    def build_gravity_octree(self):
+        # The octree over every movable object, and which objects they are. It's built again from the current
+        # positions every time, since every movable object moves each step. The octree is None if there are none.
+        arrays = self.space_object_arrays
+        attractors = arrays.indices_of('movable')
+        if len(attractors) == 0:
+            return attractors, None
+        return attractors, BarnesHutOctree(arrays.positions[attractors], arrays.masses[attractors])
+
+    def calculate_mutual_gravitational_accelerations(self, target_indices, attractors_and_octree=None):
+        # attractors_and_octree is what build_gravity_octree() returned, if it has been built already.
+        arrays = self.space_object_arrays
+        if len(target_indices) == 0:
+            return numpy.zeros((0, 3))
+        attractors, octree = attractors_and_octree or self.build_gravity_octree()
+        if octree is None:
+            return numpy.zeros((len(target_indices), 3))
+
+        return octree.calculate_accelerations(arrays.positions[target_indices],
+                                              numpy.searchsorted(attractors, target_indices),
+                                              self.opening_angle, self.softening_length)
+
+    def move_all_movable_objects(self, time_step=None):
+        # Uses Velocity Verlet integration method, on all the movable rows at once.
+        dt = time_step or self.dt
+        arrays = self.space_object_arrays
+        movable = arrays.indices_of('movable', 'awake', 'scheduled')
+        if self.level_of_detail_enabled:
+            # Every object catches up on all the time since it was last moved.
+            dt = arrays.time_since_update[movable, numpy.newaxis]
+        if self.domain_decomposition is not None:
+            self.domain_decomposition.move_objects(movable, None if self.level_of_detail_enabled else dt)
+            return
+        arrays.previous_positions[movable] = arrays.positions[movable]
+        arrays.positions[movable] = (arrays.positions[movable] + arrays.velocities[movable] * dt +
+                                     .5 * arrays.accelerations[movable] * dt * dt)
+
+    def calculate_all_velocities(self, time_step=None):
+        # The whole-array version of SpaceObject.calculate_velocity().
+        dt, e = time_step or self.dt, self.e
+        arrays = self.space_object_arrays
+        movable = arrays.indices_of('movable', 'awake', 'scheduled')
+        if self.level_of_detail_enabled:
+            dt = arrays.time_since_update[movable, numpy.newaxis]
+        effected_rows = numpy.flatnonzero(arrays.effected_by_gravity[movable])
+        effected = movable[effected_rows]
+
+        velocities = arrays.velocities[movable]
+        accelerations = arrays.accelerations[movable]
+        previous_speeds = numpy.sqrt(numpy.sum(velocities * velocities, axis=1))
+
+        velocities = velocities + .5 * accelerations * dt
+        velocities = velocities + .5 * accelerations * dt
+        sums_of_forces = arrays.constant_forces[movable]
+        time_phase = self.profiler.time_phase
+        if self.domain_decomposition is not None:
+            gravitational_accelerations = time_phase('gravity',
+                                                     self.domain_decomposition.calculate_gravitational_accelerations,
+                                                     effected)
+        else:
+            gravitational_accelerations = time_phase('gravity', self.calculate_source_gravitational_accelerations,
+                                                     effected)
+            if self.mutual_gravity:
+                gravitational_accelerations += time_phase('gravity', self.calculate_mutual_gravitational_accelerations,
+                                                          effected)
+        sums_of_forces[effected_rows] += arrays.masses[effected, numpy.newaxis] * gravitational_accelerations
+        accelerations = sums_of_forces / arrays.masses[movable, numpy.newaxis]
+
+        velocities = velocities + .5 * accelerations * dt
+
+        resting_on_gravity_source = (arrays.colliding_with_gravity_source[movable] &
+                                     ~arrays.influenced_by_non_gravity_source[movable])
+        speeds = numpy.sqrt(numpy.sum(velocities * velocities, axis=1))
+        came_to_rest = resting_on_gravity_source & (previous_speeds < speeds * (e + .1))
+        accelerations[came_to_rest] = 0.
+        velocities[came_to_rest] = 0.
+
+        arrays.sums_of_forces[movable] = sums_of_forces
+        arrays.accelerations[movable] = accelerations
+        arrays.velocities[movable] = velocities
+        arrays.colliding_with_gravity_source[movable] = False
+        arrays.influenced_by_non_gravity_source[movable] = False
+
+    def use_domain_decomposition(self, worker_count=None):
+        # Spreads integration, gravity and the broadphase over worker_count processes (one per core by default), each
+        # looking after one slab of space, with the objects' state in memory they all share. See domain_decomposition.py.
+        self.stop_domain_decomposition()
+        self.domain_decomposition = DomainDecomposition(self, worker_count)
+        self.collision_detector_and_resolver.use_broadphase(DomainDecomposedBroadphase,
+                                                            decomposition=self.domain_decomposition)
+
+    def stop_domain_decomposition(self):
+        if self.domain_decomposition is not None:
+            self.domain_decomposition.close()
+            self.domain_decomposition = None
+            self.space_object_arrays.use_array_allocator(numpy.zeros)
+            self.collision_detector_and_resolver.use_broadphase(SweepAndPruneBroadphase)
+
+    def enable_profiling(self, history_length=300):
+        # Starts timing every phase of every step. Returns the StepProfiler, which keeps the last history_length steps
+        # and hands each one to its listeners as it finishes.
+        if self.profiler is null_profiler:
+            self.profiler = StepProfiler(history_length)
+        return self.profiler
+
+    def disable_profiling(self):
+        self.profiler = null_profiler
+
+    def use_sleeping(self, sleep_speed=.1, steps_to_fall_asleep=60):
+        # Lets movable objects that have stayed slower than sleep_speed for steps_to_fall_asleep steps in a row fall
+        # asleep. Objects that are asleep are skipped by the integration, the gravity and the broadphase updates until
+        # something wakes them, see update_sleeping_objects(), so piles of settled debris cost next to nothing.
+        self.sleeping_enabled = True
+        self.sleep_speed = sleep_speed
+        self.steps_to_fall_asleep = steps_to_fall_asleep
+
+    def stop_sleeping(self):
+        self.sleeping_enabled = False
+        arrays = self.space_object_arrays
+        self.wake_objects(numpy.flatnonzero(~arrays.awake[:arrays.number_of_objects]))
+
+    def wake_objects(self, object_indices):
+        arrays = self.space_object_arrays
+        arrays.awake[object_indices] = True
+        arrays.steps_at_rest[object_indices] = 0
+        arrays.cached_indices.clear()
+
+    def update_sleeping_objects(self):
+        # Wakes the objects that have been disturbed since they fell asleep: given a velocity (by an impulse from an
+        # awake object hitting them, say), moved (pushed back out of something, or by hand), or had their constant
+        # forces changed. Everything wakes if the gravity sources change. Then puts to sleep the awake objects that
+        # have been at rest for long enough.
+        arrays = self.space_object_arrays
+        number_of_objects = arrays.number_of_objects
+        sources = arrays.indices_of('gravity_source')
+        sources_description = numpy.column_stack([arrays.positions[sources], arrays.masses[sources], arrays.radii[sources]])
+
+        sleeping = numpy.flatnonzero(arrays.movable[:number_of_objects] & ~arrays.awake[:number_of_objects])
+        if len(sleeping):
+            if not numpy.array_equal(sources_description, self.sleeping_sources_description):
+                disturbed = numpy.ones(len(sleeping), dtype=bool)
+            else:
+                disturbed = numpy.any((arrays.velocities[sleeping] != 0.) |
+                                      (arrays.positions[sleeping] != arrays.previous_positions[sleeping]) |
+                                      (arrays.constant_forces[sleeping] != arrays.sleeping_constant_forces[sleeping]),
+                                      axis=1)
+            if disturbed.any():
+                self.wake_objects(sleeping[disturbed])
+
+        awake = arrays.indices_of('movable', 'awake')
+        velocities = arrays.velocities[awake]
+        at_rest = numpy.sum(velocities * velocities, axis=1) < self.sleep_speed * self.sleep_speed
+        arrays.steps_at_rest[awake] = numpy.where(at_rest, arrays.steps_at_rest[awake] + 1, 0)
+        falling_asleep = awake[arrays.steps_at_rest[awake] >= self.steps_to_fall_asleep]
+        if len(falling_asleep):
+            arrays.awake[falling_asleep] = False
+            arrays.velocities[falling_asleep] = 0.
+            arrays.accelerations[falling_asleep] = 0.
+            arrays.previous_positions[falling_asleep] = arrays.positions[falling_asleep]
+            arrays.sleeping_constant_forces[falling_asleep] = arrays.constant_forces[falling_asleep]
+            arrays.cached_indices.clear()
+            self.sleeping_sources_description = sources_description
+
+    def use_level_of_detail(self, points_of_interest=None, tier_distances=(500., 2000.), tier_step_intervals=(1, 4, 16),
+                            isolation_distance=20.):
+        # Updates movable objects less often the less is going on around them. Tier t is moved, and has its velocity
+        # worked out, every tier_step_intervals[t] steps, over all the time since it was last updated.
+        # Objects go in a slower tier the further they are from the nearest of points_of_interest (an n x 3 array,
+        # the players, say), past each of tier_distances, or into the slowest tier if there are no points of interest.
+        # An object is then kept in a faster tier if it could come within isolation_distance of any other object
+        # before its next update, at the speed it's going, and is put back in tier 0 as soon as it touches something.
+        # Tiers are worked out again every tier_step_intervals[-1] steps, and level_of_detail_report has how many
+        # objects are in each.
+        if len(tier_distances) != len(tier_step_intervals) - 1:
+            raise ValueError('there has to be one tier distance between every two tiers')
+        self.level_of_detail_enabled = True
+        self.level_of_detail_stopping = False
+        self.tier_distances = numpy.array(tier_distances, dtype=float)
+        self.tier_step_intervals = numpy.array(tier_step_intervals, dtype=numpy.int64)
+        self.isolation_distance = isolation_distance
+        self.set_points_of_interest(points_of_interest)
+
+    def set_points_of_interest(self, points_of_interest):
+        self.points_of_interest = None if points_of_interest is None else numpy.reshape(points_of_interest, (-1, 3))
+        # Tiers are worked out again on the next step, so nothing coasts into a point of interest unnoticed.
+        self.level_of_detail_report = {}
+
+    def stop_level_of_detail(self):
+        # Everything is brought up to date on the next step, which is the last one with level of detail.
+        if self.level_of_detail_enabled:
+            self.level_of_detail_stopping = True
+
+    def assign_level_of_detail_tiers(self, objects, time_step):
+        arrays = self.space_object_arrays
+        slowest_tier = len(self.tier_step_intervals) - 1
+        speeds = numpy.sqrt(numpy.sum(arrays.velocities[objects] * arrays.velocities[objects], axis=1))
+        tiers = numpy.full(len(objects), slowest_tier, dtype=numpy.int64)
+        if self.points_of_interest is not None:
+            # Objects are tiered by how close they could have come by the time tiers are worked out again.
+            distances = (calculate_nearest_distances(arrays.positions[objects], self.points_of_interest) -
+                         speeds * self.tier_step_intervals[-1] * time_step)
+            tiers = numpy.searchsorted(self.tier_distances, distances)
+
+        # Going down from the slowest tier, objects that could reach something before their next update in one tier
+        # are tried in the next faster one. Every object's own sphere reaches itself, so that one doesn't count.
+        query_tree = self.spatial_queries()
+        for tier in xrange(slowest_tier, 0, -1):
+            in_tier = numpy.flatnonzero(tiers == tier)
+            if not len(in_tier):
+                continue
+            reaches = (arrays.radii[objects[in_tier]] + self.isolation_distance +
+                       speeds[in_tier] * self.tier_step_intervals[tier] * time_step)
+            offsets = query_tree.objects_within_spheres(arrays.positions[objects[in_tier]], reaches)[0]
+            tiers[in_tier[numpy.diff(offsets) > 1]] = tier - 1
+
+        arrays.level_of_detail_tiers[objects] = tiers
+
+    def schedule_objects(self, time_step):
+        # Picks the objects that are updated this step: every object in tier t once every tier_step_intervals[t]
+        # steps, staggered by identifier so each tier's objects are spread out evenly over its steps.
+        arrays = self.space_object_arrays
+        movable = arrays.indices_of('movable', 'awake')
+        arrays.time_since_update[movable] += time_step
+        if self.level_of_detail_stopping:
+            arrays.level_of_detail_tiers[movable] = 0
+        elif not self.level_of_detail_report or self.steps_taken % self.tier_step_intervals[-1] == 0:
+            self.assign_level_of_detail_tiers(movable, time_step)
+
+        tiers = arrays.level_of_detail_tiers[movable]
+        scheduled = (self.steps_taken + arrays.identifiers[movable]) % self.tier_step_intervals[tiers] == 0
+        arrays.scheduled[movable] = scheduled
+        # The objects left out stay where they are this step, as far as the collision detection is concerned.
+        arrays.previous_positions[movable[~scheduled]] = arrays.positions[movable[~scheduled]]
+        arrays.cached_indices.clear()
+
+        tier_counts = numpy.bincount(tiers, minlength=len(self.tier_step_intervals))
+        self.level_of_detail_report = {'tier_counts': tier_counts.tolist(), 'scheduled': int(numpy.count_nonzero(scheduled))}
+
+    def finish_scheduled_objects(self):
+        # The objects updated this step are caught up, and the ones touching something go back to tier 0 so they're
+        # updated every step from the next one on.
+        arrays = self.space_object_arrays
+        arrays.time_since_update[arrays.indices_of('movable', 'awake', 'scheduled')] = 0.
+        first_objects, second_objects = self.collision_detector_and_resolver.colliding_pairs
+        arrays.level_of_detail_tiers[first_objects] = 0
+        arrays.level_of_detail_tiers[second_objects] = 0
+        if self.level_of_detail_stopping:
+            self.level_of_detail_enabled = False
+            self.level_of_detail_stopping = False
+            self.level_of_detail_report = {}
+            arrays.scheduled[:arrays.number_of_objects] = True
+            arrays.cached_indices.clear()
+
+    def spatial_queries(self):
+        # A SphereTree over where the objects are now, for finding objects near a point, in a box or along a line
+        # without checking every one of them. It's built the first time it's asked for after anything moves, so
+        # everything asked between two steps shares one tree. Objects are given by their indices, as of now.
+        if self.query_tree is None:
+            arrays = self.space_object_arrays
+            self.query_tree = SphereTree(arrays.positions[:arrays.number_of_objects],
+                                         arrays.radii[:arrays.number_of_objects])
+        return self.query_tree
+
+    def use_change_feed(self, tolerance=1e-3):
+        # Keeps track of what has changed since it was last reported, so a renderer or a network connection only has
+        # to be sent the objects that moved. An object counts as moved once it is more than tolerance away from where
+        # it was last reported to be. go_forward_one_time_step() then returns collect_changes(), and advance() puts it
+        # in advance_report['changes'].
+        if self.change_tolerance is None:
+            arrays = self.space_object_arrays
+            arrays.synced_positions[:arrays.number_of_objects] = numpy.inf
+            self.removed_identifiers = []
+        self.change_tolerance = tolerance
+
+    def stop_change_feed(self):
+        self.change_tolerance = None
+        self.removed_identifiers = []
+
+    def collect_changes(self):
+        # Everything that changed since the last call:
+        #   {'indices': the rows of the objects that moved or were added,
+        #    'identifiers': their identifiers,
+        #    'positions': their positions, one row each,
+        #    'removed_identifiers': the identifiers of the objects removed}
+        # The objects reported are taken to be where they were reported to be from now on.
+        arrays = self.space_object_arrays
+        number_of_objects = arrays.number_of_objects
+        offsets = arrays.positions[:number_of_objects] - arrays.synced_positions[:number_of_objects]
+        # New objects' synced positions are infinitely far away, so they always count as moved.
+        moved = numpy.flatnonzero(numpy.sum(offsets * offsets, axis=1) > self.change_tolerance**2)
+        positions = arrays.positions[moved]
+        arrays.synced_positions[moved] = positions
+
+        changes = {'indices': moved, 'identifiers': arrays.identifiers[moved], 'positions': positions,
+                   'removed_identifiers': self.removed_identifiers}
+        self.removed_identifiers = []
+        return changes
+
+    def go_forward_one_time_step(self, time_step=None):
+        # Returns collect_changes() if the change feed is on.
+        self.take_one_time_step(time_step)
+        if self.change_tolerance is not None:
+            return self.collect_changes()
+
+    def take_one_time_step(self, time_step=None):
+        profiler = self.profiler
+        if self.sleeping_enabled:
+            profiler.time_phase('sleep', self.update_sleeping_objects)
+        if self.level_of_detail_enabled:
+            profiler.time_phase('level_of_detail', self.schedule_objects, time_step or self.dt)
+        profiler.time_phase('integrate', self.move_all_movable_objects, time_step)
+        profiler.time_phase('narrowphase', self.collision_detector_and_resolver.detect_all_collisions)
+        profiler.time_phase('calculate_velocities', self.calculate_all_velocities, time_step)
+        if self.level_of_detail_enabled:
+            profiler.time_phase('level_of_detail', self.finish_scheduled_objects)
+        profiler.time_phase('resolve_collisions', self.collision_detector_and_resolver.resolve_all_collisions)
+        if self.culling_bounds is not None:
+            self.cull_objects_out_of_bounds()
+        profiler.finish_step(self)
+        self.query_tree = None
+
+        self.steps_taken += 1
+        self.simulated_time += time_step or self.dt
+        for step_listener in self.step_listeners:
+            step_listener(self)
+
+    def add_step_listener(self, step_listener):
+        # step_listener(world) is called at the end of every step, e.g. by a TrajectoryRecorder.
+        self.step_listeners.append(step_listener)
+
+    def remove_step_listener(self, step_listener):
+        self.step_listeners.remove(step_listener)
+
+    def choose_substep_count(self, time_step):
+        # How many pieces a step of time_step has to be split into, from 1 to maximum_substeps, so that no pair that
+        # could meet during the step closes in by more than maximum_travel_per_substep of the smaller radius in one
+        # piece, and no object orbiting a gravity source takes fewer than substeps_per_orbit pieces to go around it.
+        arrays = self.space_object_arrays
+        substeps = 1.
+
+        # The boxes around where each object will go during the step, if it keeps going the way it's going.
+        number_of_objects = arrays.number_of_objects
+        positions = arrays.positions[:number_of_objects]
+        next_positions = positions + arrays.velocities[:number_of_objects] * time_step
+        radii = arrays.radii[:number_of_objects, numpy.newaxis]
+        mins = numpy.minimum(positions, next_positions) - radii
+        maxes = numpy.maximum(positions, next_positions) + radii
+        first_objects, second_objects = split_pair_codes(find_overlapping_boxes_in_cells(mins, maxes,
+                                                                                         choose_cell_size(mins, maxes)))
+        smaller_radii = numpy.minimum(arrays.radii[first_objects], arrays.radii[second_objects])
+        vectors_between_centers = arrays.positions[first_objects] - arrays.positions[second_objects]
+        velocity_differences = arrays.velocities[first_objects] - arrays.velocities[second_objects]
+        distances_between_centers = numpy.sqrt(numpy.sum(vectors_between_centers * vectors_between_centers, axis=1))
+        measurable = (smaller_radii > 0.) & (distances_between_centers > 0.)
+        if measurable.any():
+            closing_speeds = -numpy.sum(vectors_between_centers[measurable] * velocity_differences[measurable],
+                                        axis=1) / distances_between_centers[measurable]
+            substeps = max(substeps, numpy.max(closing_speeds * time_step /
+                                               (self.maximum_travel_per_substep * smaller_radii[measurable])))
+
+        # With the pull from the closest source at distance r being GM/r^2, an orbit at r takes 2 pi sqrt(r / pull).
+        effected = arrays.indices_of('movable', 'effected_by_gravity')
+        sources = arrays.indices_of('gravity_source')
+        if len(effected) and len(sources):
+            distances = calculate_nearest_distances(arrays.positions[effected], arrays.positions[sources])
+            pulls = numpy.sqrt(numpy.sum(arrays.accelerations[effected] * arrays.accelerations[effected], axis=1))
+            pulled = pulls > 0.
+            if pulled.any():
+                shortest_orbit = 2. * numpy.pi * numpy.min(numpy.sqrt(distances[pulled] / pulls[pulled]))
+                substeps = max(substeps, time_step * self.substeps_per_orbit / shortest_orbit)
+
+        return int(min(numpy.ceil(substeps), self.maximum_substeps))
+
+    def advance(self, elapsed_time):
+        # Moves the world forward by elapsed_time of real time, in as many steps of dt as fit into it. What's left over
+        # is carried on to the next call. No more than maximum_steps_per_advance steps are taken, and any time beyond
+        # that is dropped, so a slow frame can't make the next one slower still. Each step is split into substeps
+        # when fast approaches or tight orbits need them, see choose_substep_count().
+        # Returns how far the leftover time is into the next step, from 0 to 1, for interpolated_positions().
+        self.unsimulated_time += elapsed_time
+        steps = int(self.unsimulated_time // self.dt)
+        dropped_time = 0.
+        if steps > self.maximum_steps_per_advance:
+            dropped_time = (steps - self.maximum_steps_per_advance) * self.dt
+            self.unsimulated_time -= dropped_time
+            steps = self.maximum_steps_per_advance
+
+        arrays = self.space_object_arrays
+        total_substeps = 0
+        for step in xrange(steps):
+            if step == steps - 1:
+                self.positions_before_last_step = arrays.positions[:arrays.number_of_objects].copy()
+
+            substeps = self.choose_substep_count(self.dt) if self.maximum_substeps > 1 else 1
+            for substep in xrange(substeps):
+                self.take_one_time_step(self.dt / substeps)
+            total_substeps += substeps
+            self.unsimulated_time -= self.dt
+
+        self.unsimulated_time = max(self.unsimulated_time, 0.)
+        self.advance_report = {'steps': steps, 'substeps': total_substeps, 'dropped_time': dropped_time}
+        if self.change_tolerance is not None:
+            self.advance_report['changes'] = self.collect_changes()
+        return min(self.unsimulated_time / self.dt, 1.)
+
+    def interpolated_positions(self, interpolation_factor):
+        # Where every object is drawn when the last advance() returned interpolation_factor: partway from where it was
+        # before the last step to where it is now. Objects added since then are drawn where they are.
+        arrays = self.space_object_arrays
+        positions = arrays.positions[:arrays.number_of_objects].copy()
+        if self.positions_before_last_step is not None:
+            stepped = len(self.positions_before_last_step)
+            positions[:stepped] = ((1. - interpolation_factor) * self.positions_before_last_step +
+                                   interpolation_factor * positions[:stepped])
+        return positions
+
+
+class DefaultWorld(World):
+    # The world the module-level names below belong to, for code written before there could be more than one. Its
+    # time step and coefficient of restitution are the module's dt and e, read whenever they're used, so scripts that
+    # set physics_manager.dt or physics_manager.e still change them. Setting default_world.dt or .e overrides that.
+    def __init__(self):
+        World.__init__(self)
+        del self.dt, self.e
+
+    def __getattr__(self, name):
+        if name in ('dt', 'e'):
+            return globals()[name]
+        raise AttributeError(name)
+
+
+default_world = DefaultWorld()
+space_object_arrays = default_world.space_object_arrays
+all_objects = default_world.all_objects
+movable_objects = default_world.movable_objects
+objects_effected_by_gravity = default_world.objects_effected_by_gravity
+gravity_sources = default_world.gravity_sources
+collision_detector_and_resolver = default_world.collision_detector_and_resolver
+
+calculate_all_gravitational_forces = default_world.calculate_all_gravitational_forces
+use_cached_gravity_field = default_world.use_cached_gravity_field
+use_exact_gravity_field = default_world.use_exact_gravity_field
+calculate_source_gravitational_accelerations = default_world.calculate_source_gravitational_accelerations
+use_mutual_gravity = default_world.use_mutual_gravity
+use_gravity_sources_only = default_world.use_gravity_sources_only
+calculate_mutual_gravitational_accelerations = default_world.calculate_mutual_gravitational_accelerations
+move_all_movable_objects = default_world.move_all_movable_objects
+calculate_all_velocities = default_world.calculate_all_velocities
+enable_profiling = default_world.enable_profiling
+disable_profiling = default_world.disable_profiling
+go_forward_one_time_step = default_world.go_forward_one_time_step
+advance = default_world.advance
+interpolated_positions = default_world.interpolated_positions
+add_step_listener = default_world.add_step_listener
+remove_step_listener = default_world.remove_step_listener
+use_change_feed = default_world.use_change_feed
+stop_change_feed = default_world.stop_change_feed
+collect_changes = default_world.collect_changes
+spatial_queries = default_world.spatial_queries
+use_domain_decomposition = default_world.use_domain_decomposition
+stop_domain_decomposition = default_world.stop_domain_decomposition
+create_space_objects = default_world.create_space_objects
+remove_space_object = default_world.remove_space_object
+remove_space_objects = default_world.remove_space_objects
+use_culling_bounds = default_world.use_culling_bounds
+stop_culling = default_world.stop_culling
+use_sleeping = default_world.use_sleeping
+stop_sleeping = default_world.stop_sleeping
+use_level_of_detail = default_world.use_level_of_detail
+set_points_of_interest = default_world.set_points_of_interest
+stop_level_of_detail = default_world.stop_level_of_detail
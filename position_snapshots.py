@@ -0,0 +1,98 @@
+import sys
+import threading
+import time
+
+import numpy
+
+
+__author__ = 'Jacob'
+
+
+class PositionSnapshot:
+    # Where every object was at the end of one step. Rows line up with identifiers, not with the world's rows, which
+    # may have moved since. The arrays are read-only; a snapshot is never changed while anything other than its
+    # publisher holds it.
+    def __init__(self, number_of_objects):
+        self.step = 0
+        self.time = 0.
+        self.identifiers = numpy.zeros(number_of_objects, dtype=numpy.int64)
+        self.positions = numpy.zeros((number_of_objects, 3))
+        self.identifiers.flags.writeable = False
+        self.positions.flags.writeable = False
+
+    def fill(self, world):
+        arrays = world.space_object_arrays
+        number_of_objects = arrays.number_of_objects
+        self.step = world.steps_taken
+        self.time = world.simulated_time
+        self.identifiers.flags.writeable = True
+        self.positions.flags.writeable = True
+        self.identifiers[:] = arrays.identifiers[:number_of_objects]
+        self.positions[:] = arrays.positions[:number_of_objects]
+        self.identifiers.flags.writeable = False
+        self.positions.flags.writeable = False
+
+
+class SnapshotPublisher:
+    # Publishes a snapshot of every position after each step of the world it's attached to. Another thread (a
+    # renderer, say) takes latest_snapshot whenever it likes and reads it for as long as it likes, with no locking:
+    # swapping latest_snapshot is a single assignment, and the snapshot being filled is never the latest one.
+    # Two snapshots are swapped between. If a reader is still holding on to the one due to be filled next, a new one
+    # is made instead, so nothing a reader holds ever changes under it.
+    def __init__(self):
+        self.latest_snapshot = None
+        self.spare_snapshot = None
+        self.world = None
+
+    def attach(self, world):
+        self.world = world
+        world.add_step_listener(self.publish)
+        self.publish(world)
+
+    def detach(self):
+        if self.world is not None:
+            self.world.remove_step_listener(self.publish)
+            self.world = None
+
+    def publish(self, world):
+        snapshot = self.spare_snapshot
+        self.spare_snapshot = None
+        number_of_objects = world.space_object_arrays.number_of_objects
+        # Nothing but the snapshot variable here should be holding the spare (getrefcount counts its own argument too),
+        # and nothing but the snapshot should be holding its arrays.
+        if (snapshot is None or len(snapshot.identifiers) != number_of_objects or sys.getrefcount(snapshot) > 2 or
+                sys.getrefcount(snapshot.identifiers) > 2 or sys.getrefcount(snapshot.positions) > 2):
+            snapshot = PositionSnapshot(number_of_objects)
+
+        snapshot.fill(world)
+        self.spare_snapshot = self.latest_snapshot
+        self.latest_snapshot = snapshot
+
+
+class PhysicsThread(threading.Thread):
+    # Runs world.advance() in real time on a thread of its own, so the physics doesn't have to wait for frames to be
+    # drawn, and the renderer reads the publisher's latest_snapshot whenever it draws one. With a time_scale other
+    # than 1 the world runs that many times faster than real time.
+    def __init__(self, world, publisher=None, time_scale=1.):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.world = world
+        self.time_scale = time_scale
+        self.publisher = publisher or SnapshotPublisher()
+        self.publisher.attach(world)
+        self.stopping = False
+
+    def run(self):
+        previous_time = time.time()
+        while not self.stopping:
+            current_time = time.time()
+            self.world.advance((current_time - previous_time) * self.time_scale)
+            previous_time = current_time
+
+            # Sleeps until the next step is due.
+            time.sleep(max(self.world.dt - self.world.unsimulated_time, 0.) / self.time_scale)
+
+    def stop(self):
+        self.stopping = True
+        self.join()
+        self.publisher.detach()
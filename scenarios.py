@@ -0,0 +1,138 @@
+import numpy
+
+from physics_manager import World
+
+
+__author__ = 'Jacob'
+
+
+# The scenes from the test scripts, without the visuals, so they can be run headless. Each one fills the given world
+# and takes its random numbers from random_state so a seed always gives the same scene.
+
+
+def create_test1_scene(world, random_state):
+    for i in xrange(45):
+        position = random_state.uniform(-300, 300, (3,1))
+        velocity = random_state.uniform(-50, 50, (3,1))
+        radius = random_state.uniform(1, 5)
+        mass = random_state.uniform(1, 10)
+        world.add_space_object(position, velocity, radius, mass)
+
+    for i in xrange(5):
+        position = random_state.uniform(-300, 300, (3,1))
+        velocity = random_state.uniform(-10, 10, (3,1))
+        radius = random_state.uniform(1, 5)
+        mass = random_state.uniform(1, 10)
+        world.add_space_object(position, velocity, radius, mass, effected_by_gravity=False)
+
+    for i in xrange(3):
+        position = random_state.uniform(-300, 300, (3,1))
+        velocity = numpy.zeros((3,1))
+        radius = random_state.uniform(20, 50)
+        mass = radius*50000.
+        world.add_space_object(position, velocity, radius, mass, gravity_source=True)
+
+
+def create_test2_scene(world, random_state):
+    world.add_space_object(numpy.array([[0.], [0.], [0.]]), numpy.array([[0.], [0.], [0.]]), 5., 10., gravity_source=True)
+    world.add_space_object(numpy.array([[10.], [0.], [0.]]), numpy.array([[-50.], [0.], [0.]]), 1., 1.)
+
+    for position in ((-200., 0., 4.), (-160., 1., 0.), (-140., 2., -4.), (-120., 3., 2.),
+                     (-100., 4., 0.), (-80., 5., -2.), (-60., 6., 0.)):
+        world.add_space_object(numpy.array(position).reshape(3, 1), numpy.array([[50.], [0.], [0.]]), 5., 5.)
+
+    world.add_space_object(numpy.array([[100.], [0.], [0.]]), numpy.array([[-50.], [0.], [0.]]), 5., 5.)
+
+
+def create_test3_scene(world, random_state):
+    world.add_space_object(numpy.array([[30.], [0.], [0.]]), numpy.array([[0.], [18.], [0.]]), 1., 10.)
+    world.add_space_object(numpy.array([[0.], [0.], [0.]]), numpy.array([[0.], [0.], [0.]]), 5., 5.*2500.,
+                           gravity_source=True)
+
+
+def create_test4_scene(world, random_state):
+    for i in xrange(10):
+        position = random_state.uniform(-50, 50, (3,1))
+        world.add_space_object(position, numpy.zeros((3,1)), 1, 10)
+
+    world.add_space_object(numpy.array([[0.], [0.], [0.]]), numpy.array([[0.], [0.], [0.]]), 10, 10*2500.,
+                           gravity_source=True)
+
+
+# Synthetic scenes that can be made with any number of objects, for seeing how the physics scales.
+
+
+def create_uniform_cloud_scene(world, random_state, number_of_objects):
+    # Objects spread evenly through a cube that grows with the count, so the density stays the same.
+    half_side = 10. * number_of_objects**(1./3.)
+    for i in xrange(number_of_objects):
+        position = random_state.uniform(-half_side, half_side, (3,1))
+        velocity = random_state.uniform(-5, 5, (3,1))
+        radius = random_state.uniform(.5, 1.5)
+        mass = random_state.uniform(1, 10)
+        world.add_space_object(position, velocity, radius, mass)
+
+
+def create_pile_scene(world, random_state, number_of_objects):
+    # Objects packed into a shell just above a gravity source, so they fall onto it and onto each other.
+    source_radius = max(10., 2. * number_of_objects**(1./3.))
+    world.add_space_object(numpy.zeros((3,1)), numpy.zeros((3,1)), source_radius, source_radius*2500.,
+                           gravity_source=True)
+
+    # About a third of the shell is filled with objects.
+    shell_thickness = 3. * number_of_objects * (4./3. * numpy.pi) / (4. * numpy.pi * source_radius**2)
+    for i in xrange(number_of_objects):
+        direction = random_state.normal(size=(3,1))
+        direction /= numpy.linalg.norm(direction)
+        height = source_radius + 1. + random_state.uniform(0, shell_thickness)
+        world.add_space_object(direction * height, numpy.zeros((3,1)), 1., random_state.uniform(1, 10))
+
+
+def create_column_scene(world, random_state, number_of_objects):
+    # Objects lined up in columns along the x axis, which sweep and prune handles worst.
+    number_of_columns = max(1, int(number_of_objects**.5 / 4))
+    columns_per_side = int(numpy.ceil(number_of_columns**.5))
+    for i in xrange(number_of_objects):
+        column = i % number_of_columns
+        position = numpy.array([[3. * (i // number_of_columns)],
+                                [10. * (column % columns_per_side)],
+                                [10. * (column // columns_per_side)]])
+        position += random_state.uniform(-.1, .1, (3,1))
+        velocity = numpy.array([[random_state.uniform(-5, 5)], [0.], [0.]])
+        world.add_space_object(position, velocity, 1., random_state.uniform(1, 10))
+
+
+def create_many_sources_scene(world, random_state, number_of_objects):
+    # Objects flying through a field of one gravity source for every hundred of them.
+    half_side = 10. * number_of_objects**(1./3.) + 100.
+    for i in xrange(max(3, number_of_objects // 100)):
+        position = random_state.uniform(-half_side, half_side, (3,1))
+        radius = random_state.uniform(5, 20)
+        world.add_space_object(position, numpy.zeros((3,1)), radius, radius*2500., gravity_source=True)
+
+    for i in xrange(number_of_objects):
+        position = random_state.uniform(-half_side, half_side, (3,1))
+        velocity = random_state.uniform(-20, 20, (3,1))
+        world.add_space_object(position, velocity, random_state.uniform(.5, 1.5), random_state.uniform(1, 10))
+
+
+scenarios = {'test1': create_test1_scene,
+             'test2': create_test2_scene,
+             'test3': create_test3_scene,
+             'test4': create_test4_scene}
+
+synthetic_scenarios = {'uniform_cloud': create_uniform_cloud_scene,
+                       'pile': create_pile_scene,
+                       'columns': create_column_scene,
+                       'many_sources': create_many_sources_scene}
+
+
+def create_world(scenario_name, seed=None, number_of_objects=None, **world_options):
+    # number_of_objects is only used by the synthetic scenarios.
+    world = World(**world_options)
+    random_state = numpy.random.RandomState(seed)
+    if scenario_name in synthetic_scenarios:
+        synthetic_scenarios[scenario_name](world, random_state, number_of_objects)
+    else:
+        scenarios[scenario_name](world, random_state)
+    return world
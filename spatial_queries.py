@@ -0,0 +1,221 @@
+import numpy
+
+from array_helpers import expand_ranges
+from barnes_hut_octree import MortonOrderedTree, reduce_over_ranges
+
+
+__author__ = 'Jacob'
+
+
+# Every query comes in a batched form, which answers many queries with one walk of the tree, and a form for a single
+# query. The batched forms that can find any number of objects per query return them the way a CSR matrix stores
+# its rows: the objects found for query i are objects[offsets[i]:offsets[i + 1]], in increasing order.
+
+
+def segment_overlaps_boxes(segment_starts, segment_directions, lower_corners, upper_corners):
+    # Whether each segment, from start to start + direction, passes through its box.
+    parallel = segment_directions == 0.
+    safe_directions = numpy.where(parallel, 1., segment_directions)
+    entry_times = (lower_corners - segment_starts) / safe_directions
+    exit_times = (upper_corners - segment_starts) / safe_directions
+    # A segment parallel to a pair of the box's sides is between them the whole way or not at all.
+    between_sides = (lower_corners <= segment_starts) & (segment_starts <= upper_corners)
+    near_times = numpy.where(parallel, numpy.where(between_sides, -numpy.inf, numpy.inf),
+                             numpy.minimum(entry_times, exit_times))
+    far_times = numpy.where(parallel, numpy.where(between_sides, numpy.inf, -numpy.inf),
+                            numpy.maximum(entry_times, exit_times))
+    return numpy.maximum(near_times.max(axis=1), 0.) <= numpy.minimum(far_times.min(axis=1), 1.)
+
+
+def squared_distances_to_boxes(points, lower_corners, upper_corners):
+    offsets = numpy.clip(points, lower_corners, upper_corners) - points
+    return numpy.sum(offsets * offsets, axis=1)
+
+
+def group_by_query(number_of_queries, queries, objects):
+    order = numpy.lexsort((objects, queries))
+    offsets = numpy.searchsorted(queries[order], numpy.arange(number_of_queries + 1))
+    return offsets, objects[order]
+
+
+class SphereTree(MortonOrderedTree):
+    # A MortonOrderedTree over the objects' spheres, with the box around every node's spheres, for answering spatial
+    # queries in time that grows with how much they find rather than with the number of objects.
+    # Objects are given as their indices into the positions and radii the tree was built from.
+    def __init__(self, positions, radii, leaf_size=8, queries_per_chunk=1024):
+        self.number_of_bodies = len(positions)
+        self.queries_per_chunk = queries_per_chunk
+        if not self.number_of_bodies:
+            return
+
+        MortonOrderedTree.__init__(self, positions, leaf_size)
+        self.sorted_radii = radii[self.sorted_order]
+        self.node_lower_corners = reduce_over_ranges(numpy.minimum,
+                                                     self.sorted_positions - self.sorted_radii[:, numpy.newaxis],
+                                                     self.node_starts, self.node_ends)
+        self.node_upper_corners = reduce_over_ranges(numpy.maximum,
+                                                     self.sorted_positions + self.sorted_radii[:, numpy.newaxis],
+                                                     self.node_starts, self.node_ends)
+
+    def walk(self, number_of_queries, node_is_wanted, body_is_wanted):
+        # Walks the tree for all the queries at once, opening the nodes node_is_wanted(queries, nodes) says might
+        # hold something the query wants, and keeping the bodies body_is_wanted(queries, sorted_bodies) says it does.
+        # Returns the queries and the objects they found, one pair each.
+        found_queries = [numpy.zeros(0, dtype=numpy.int64)]
+        found_bodies = [numpy.zeros(0, dtype=numpy.int64)]
+        if not self.number_of_bodies:
+            return found_queries[0], found_bodies[0]
+
+        for query_start in xrange(0, number_of_queries, self.queries_per_chunk):
+            queries = numpy.arange(query_start, min(query_start + self.queries_per_chunk, number_of_queries))
+            nodes = numpy.zeros(len(queries), dtype=numpy.int64)
+
+            while len(queries):
+                wanted = node_is_wanted(queries, nodes)
+                queries, nodes = queries[wanted], nodes[wanted]
+
+                leaves = self.node_is_leaf[nodes]
+                leaf_pairs, bodies = expand_ranges(self.node_starts[nodes[leaves]], self.node_ends[nodes[leaves]])
+                leaf_queries = queries[leaves][leaf_pairs]
+                wanted = body_is_wanted(leaf_queries, bodies)
+                found_queries.append(leaf_queries[wanted])
+                found_bodies.append(bodies[wanted])
+
+                opened = ~leaves
+                child_pairs, nodes = expand_ranges(self.node_first_children[nodes[opened]],
+                                                   self.node_first_children[nodes[opened]] + self.node_child_counts[nodes[opened]])
+                queries = queries[opened][child_pairs]
+
+        return numpy.concatenate(found_queries), self.sorted_order[numpy.concatenate(found_bodies)]
+
+    def objects_in_boxes(self, lower_corners, upper_corners):
+        # The objects whose spheres reach into each box. Returns offsets and objects, see the top of this file.
+        lower_corners = numpy.reshape(lower_corners, (-1, 3))
+        upper_corners = numpy.reshape(upper_corners, (-1, 3))
+
+        def node_is_wanted(queries, nodes):
+            return numpy.all((self.node_lower_corners[nodes] <= upper_corners[queries]) &
+                             (lower_corners[queries] <= self.node_upper_corners[nodes]), axis=1)
+
+        def body_is_wanted(queries, bodies):
+            return (squared_distances_to_boxes(self.sorted_positions[bodies], lower_corners[queries],
+                                               upper_corners[queries]) <= self.sorted_radii[bodies]**2)
+
+        return group_by_query(len(lower_corners), *self.walk(len(lower_corners), node_is_wanted, body_is_wanted))
+
+    def objects_within_spheres(self, centers, radii, centers_only=False):
+        # The objects whose spheres reach into each sphere, or with centers_only, the objects whose centers are in it.
+        # Returns offsets and objects, see the top of this file.
+        centers = numpy.reshape(centers, (-1, 3))
+        radii = numpy.zeros(len(centers)) + radii
+
+        def node_is_wanted(queries, nodes):
+            return (squared_distances_to_boxes(centers[queries], self.node_lower_corners[nodes],
+                                               self.node_upper_corners[nodes]) <= radii[queries]**2)
+
+        def body_is_wanted(queries, bodies):
+            offsets = self.sorted_positions[bodies] - centers[queries]
+            reach = radii[queries] if centers_only else radii[queries] + self.sorted_radii[bodies]
+            return numpy.sum(offsets * offsets, axis=1) <= reach * reach
+
+        return group_by_query(len(centers), *self.walk(len(centers), node_is_wanted, body_is_wanted))
+
+    def nearest_objects_to_points(self, points, k):
+        # The k objects whose centers are nearest each point, nearest first, and how far their centers are.
+        # Each point is searched for within a radius that is doubled until it holds k centers. If there are fewer than
+        # k objects, the rest of each row is -1 and inf.
+        points = numpy.reshape(points, (-1, 3))
+        number_of_points = len(points)
+        nearest_objects = numpy.full((number_of_points, k), -1, dtype=numpy.int64)
+        nearest_distances = numpy.full((number_of_points, k), numpy.inf)
+        found_count = min(k, self.number_of_bodies)
+        if not found_count or not number_of_points:
+            return nearest_objects, nearest_distances
+
+        # The first radius would hold about k centers if the objects were spread evenly through the root node.
+        root_size = self.node_sizes[0]
+        search_radii = numpy.full(number_of_points, max(root_size * (float(k) / self.number_of_bodies)**(1./3.), 1e-9))
+        unfinished = numpy.arange(number_of_points)
+        while len(unfinished):
+            offsets, objects = self.objects_within_spheres(points[unfinished], search_radii[unfinished], True)
+            counts = numpy.diff(offsets)
+            # Once a radius reaches past the far side of the root node, it holds every object there is.
+            offsets_to_first_body = points[unfinished] - self.sorted_positions[0]
+            finished = (counts >= found_count) | (search_radii[unfinished] >
+                                                  numpy.sqrt(numpy.sum(offsets_to_first_body * offsets_to_first_body,
+                                                                       axis=1)) + 3.**.5 * root_size)
+
+            rows = numpy.repeat(numpy.arange(len(unfinished)), counts)
+            kept = finished[rows]
+            rows, objects = rows[kept], objects[kept]
+            offsets_to_objects = self.sorted_positions[self.sorted_position_of_body[objects]] - points[unfinished[rows]]
+            distances = numpy.sqrt(numpy.sum(offsets_to_objects * offsets_to_objects, axis=1))
+            # Sorted by distance, then by object, so ties always come out the same way.
+            order = numpy.lexsort((objects, distances, rows))
+            rows, objects, distances = rows[order], objects[order], distances[order]
+            ranks = numpy.arange(len(rows)) - numpy.searchsorted(rows, rows)
+            kept = ranks < found_count
+            nearest_objects[unfinished[rows[kept]], ranks[kept]] = objects[kept]
+            nearest_distances[unfinished[rows[kept]], ranks[kept]] = distances[kept]
+
+            search_radii[unfinished[~finished]] *= 2.
+            unfinished = unfinished[~finished]
+
+        return nearest_objects, nearest_distances
+
+    def cast_segments(self, segment_starts, segment_ends):
+        # The first object each segment hits, from its start to its end, and how far along the segment it is hit,
+        # from 0 to 1. Segments starting inside an object hit it at 0. Segments that hit nothing get -1 and inf.
+        segment_starts = numpy.reshape(segment_starts, (-1, 3)).astype(float)
+        segment_directions = numpy.reshape(segment_ends, (-1, 3)) - segment_starts
+        number_of_segments = len(segment_starts)
+
+        def node_is_wanted(queries, nodes):
+            return segment_overlaps_boxes(segment_starts[queries], segment_directions[queries],
+                                          self.node_lower_corners[nodes], self.node_upper_corners[nodes])
+
+        def hit_fractions(queries, bodies):
+            # Solves |start + t direction - center| = radius for the first t.
+            directions = segment_directions[queries]
+            offsets = segment_starts[queries] - self.sorted_positions[bodies]
+            a = numpy.sum(directions * directions, axis=1)
+            half_b = numpy.sum(directions * offsets, axis=1)
+            c = numpy.sum(offsets * offsets, axis=1) - self.sorted_radii[bodies]**2
+            discriminants = half_b * half_b - a * c
+            fractions = numpy.full(len(queries), numpy.inf)
+            crossing = (discriminants >= 0.) & (a > 0.)
+            fractions[crossing] = (-half_b[crossing] - numpy.sqrt(discriminants[crossing])) / a[crossing]
+            fractions[(fractions < 0.) | (fractions > 1.)] = numpy.inf
+            fractions[c <= 0.] = 0.
+            return fractions
+
+        def body_is_wanted(queries, bodies):
+            return hit_fractions(queries, bodies) <= 1.
+
+        queries, objects = self.walk(number_of_segments, node_is_wanted, body_is_wanted)
+        hit_objects = numpy.full(number_of_segments, -1, dtype=numpy.int64)
+        fractions_along = numpy.full(number_of_segments, numpy.inf)
+        if len(queries):
+            fractions = hit_fractions(queries, self.sorted_position_of_body[objects])
+            order = numpy.lexsort((objects, fractions, queries))
+            queries, objects, fractions = queries[order], objects[order], fractions[order]
+            first_hits = numpy.concatenate([[True], queries[1:] != queries[:-1]])
+            hit_objects[queries[first_hits]] = objects[first_hits]
+            fractions_along[queries[first_hits]] = fractions[first_hits]
+        return hit_objects, fractions_along
+
+    # One query at a time.
+
+    def objects_in_box(self, lower_corner, upper_corner):
+        return self.objects_in_boxes(lower_corner, upper_corner)[1]
+
+    def objects_within(self, center, radius, centers_only=False):
+        return self.objects_within_spheres(center, radius, centers_only)[1]
+
+    def nearest_objects(self, point, k=1):
+        nearest_objects, nearest_distances = self.nearest_objects_to_points(point, k)
+        return nearest_objects[0], nearest_distances[0]
+
+    def cast_segment(self, segment_start, segment_end):
+        hit_objects, fractions_along = self.cast_segments(segment_start, segment_end)
+        return hit_objects[0], fractions_along[0]
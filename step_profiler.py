@@ -0,0 +1,101 @@
+from timeit import default_timer
+
+import numpy
+
+
+__author__ = 'Jacob'
+
+
+# The phases of a time step, in the order they happen. A phase that runs inside another (broadphase inside
+# narrowphase, gravity inside calculate_velocities) has its time taken out of the outer one.
+phase_names = ('sleep', 'level_of_detail', 'integrate', 'broadphase', 'narrowphase', 'gravity', 'calculate_velocities',
+               'resolve_collisions')
+counter_names = ('bodies_integrated', 'bodies_asleep', 'potentially_colliding_pairs', 'colliding_pairs',
+                 'back_off_iterations', 'contact_islands', 'largest_contact_island')
+
+
+class NullProfiler:
+    # What a world uses while profiling is off: runs the phases and records nothing.
+    def time_phase(self, phase_name, phase, *arguments):
+        return phase(*arguments)
+
+    def finish_step(self, world):
+        pass
+
+
+null_profiler = NullProfiler()
+
+
+class StepProfiler:
+    # Times every phase of each step and keeps the counters the step reported, for the last history_length steps.
+    # Every listener is called at the end of each step with that step's record:
+    #   {'step': step number, 'phase_seconds': {phase name: seconds}, 'counters': {counter name: count}}
+    def __init__(self, history_length=300):
+        self.history_length = history_length
+        self.listeners = []
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.phase_time_history = numpy.zeros((self.history_length, len(phase_names)))
+        self.counter_history = numpy.zeros((self.history_length, len(counter_names)), dtype=numpy.int64)
+        self.total_phase_times = dict.fromkeys(phase_names, 0.)
+        self.phase_times = dict.fromkeys(phase_names, 0.)
+        # How long the phases running inside each phase that is running now have taken so far.
+        self.nested_times = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def time_phase(self, phase_name, phase, *arguments):
+        self.nested_times.append(0.)
+        start_time = default_timer()
+        try:
+            return phase(*arguments)
+        finally:
+            elapsed_time = default_timer() - start_time
+            self.phase_times[phase_name] += elapsed_time - self.nested_times.pop()
+            if self.nested_times:
+                self.nested_times[-1] += elapsed_time
+
+    def finish_step(self, world):
+        counters = dict.fromkeys(counter_names, 0)
+        counters.update((counter_name, count)
+                        for counter_name, count in world.collision_detector_and_resolver.step_report.items()
+                        if counter_name in counters)
+        arrays = world.space_object_arrays
+        counters['bodies_integrated'] = len(arrays.indices_of('movable', 'awake', 'scheduled'))
+        counters['bodies_asleep'] = len(arrays.indices_of('movable')) - len(arrays.indices_of('movable', 'awake'))
+
+        row = self.steps % self.history_length
+        self.phase_time_history[row] = [self.phase_times[phase_name] for phase_name in phase_names]
+        self.counter_history[row] = [counters[counter_name] for counter_name in counter_names]
+        for phase_name in phase_names:
+            self.total_phase_times[phase_name] += self.phase_times[phase_name]
+
+        step_record = {'step': self.steps, 'phase_seconds': self.phase_times, 'counters': counters}
+        self.steps += 1
+        self.phase_times = dict.fromkeys(phase_names, 0.)
+        for listener in self.listeners:
+            listener(step_record)
+
+    def rolling_statistics(self):
+        # The mean, 95th percentile and max of every phase time and counter over the steps still in the history.
+        recorded_steps = min(self.steps, self.history_length)
+        statistics = {'steps': recorded_steps, 'phase_seconds': {}, 'counters': {}}
+        if recorded_steps == 0:
+            return statistics
+
+        for names, history, kind in ((phase_names, self.phase_time_history, 'phase_seconds'),
+                                     (counter_names, self.counter_history, 'counters')):
+            history = history[:recorded_steps]
+            means = history.mean(axis=0)
+            percentile_95s = numpy.percentile(history, 95, axis=0)
+            maxes = history.max(axis=0)
+            for column, name in enumerate(names):
+                statistics[kind][name] = {'mean': float(means[column]), 'p95': float(percentile_95s[column]),
+                                          'max': float(maxes[column])}
+        return statistics
@@ -5,6 +5,7 @@ import numpy
 from visual import *
 
 import physics_manager
+from position_snapshots import PhysicsThread
 
 
 __author__ = 'Jacob'
@@ -59,11 +60,18 @@ create_sphere_visual(object10, color.orange)
 
 
 
-for i in xrange(30000):
-    rate(100)
+# The physics runs on a thread of its own, 100 steps a second like this scene always has (faster than real time),
+# and each frame draws the last step it finished.
+physics_thread = PhysicsThread(physics_manager.default_world, time_scale=100 / 60.)
+physics_thread.start()
+visuals_by_identifier = dict((space_object.identifier, visualization)
+                             for space_object, visualization in objects_and_visual_pairs)
 
-    for j in xrange(1):
-        physics_manager.go_forward_one_time_step()
+for i in xrange(30000):
+    rate(60)
 
-    for set_of_objects in objects_and_visual_pairs:
-        set_of_objects[1].pos = set_of_objects[0].position
+    snapshot = physics_thread.publisher.latest_snapshot
+    for identifier, position in zip(snapshot.identifiers, snapshot.positions):
+        visuals_by_identifier[identifier].pos = position.reshape(3, 1)
+    # Let go of it so the publisher can fill it again.
+    del snapshot
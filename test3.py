@@ -4,6 +4,7 @@ import numpy
 from visual import *
 
 import physics_manager
+from position_snapshots import PhysicsThread
 
 
 def create_sphere_visual(space_object, object_color = color.white, radius = 1):
@@ -43,12 +44,17 @@ for i in xrange(1):
     new_visualization = create_sphere_visual(new_object, color.cyan, radius)
     objects_and_visual_pairs.append([new_object, new_visualization])
 
+# The physics runs in real time on a thread of its own, and each frame draws the last step it finished.
+physics_thread = PhysicsThread(physics_manager.default_world)
+physics_thread.start()
+visuals_by_identifier = dict((space_object.identifier, visualization)
+                             for space_object, visualization in objects_and_visual_pairs)
+
 for i in xrange(30000):
     rate(60)
 
-    for j in xrange(1):
-        physics_manager.go_forward_one_time_step()
-
-    for set_of_objects in objects_and_visual_pairs:
-        set_of_objects[1].pos = set_of_objects[0].position
-
+    snapshot = physics_thread.publisher.latest_snapshot
+    for identifier, position in zip(snapshot.identifiers, snapshot.positions):
+        visuals_by_identifier[identifier].pos = position.reshape(3, 1)
+    # Let go of it so the publisher can fill it again.
+    del snapshot
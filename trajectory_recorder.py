@@ -0,0 +1,223 @@
+import bisect
+import json
+import os
+import threading
+
+import numpy
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+__author__ = 'Jacob'
+
+
+# A recording is a directory holding index.json and chunks of raw little-endian arrays. Each chunk covers up to
+# steps_per_chunk consecutive steps, with one row per object per step, so objects can come and go between steps:
+#   <chunk>.positions      rows x 3, the recording's dtype
+#   <chunk>.velocities     rows x 3, the recording's dtype
+#   <chunk>.identifiers    rows, int64
+#   <chunk>.step_rows      steps + 1, int64: where each step's rows start, and where the last one ends
+#   <chunk>.times          steps, float64: the simulated time at the end of each step
+#   <chunk>.contacts       contacts x 3, int64: the step and the two identifiers of every contact resolved
+# index.json lists the chunks in order and is rewritten every time a chunk is finished, so a recording that was cut
+# short can still be read up to its last finished chunk.
+
+
+def write_index(directory, index):
+    temporary_path = os.path.join(directory, 'index.json.tmp')
+    with open(temporary_path, 'w') as index_file:
+        json.dump(index, index_file, indent=1)
+    os.rename(temporary_path, os.path.join(directory, 'index.json'))
+
+
+def chunk_path(directory, chunk_name, array_name):
+    return os.path.join(directory, chunk_name + '.' + array_name)
+
+
+class TrajectoryRecorder:
+    # Records every step of a world it is attached to. The step listener only copies the world's state and queues it;
+    # the writing is done by a thread of its own into memory-mapped chunk files, so the physics doesn't wait on the
+    # disk. At most maximum_queued_steps steps are held in memory at once, after which the physics does wait.
+    def __init__(self, directory, steps_per_chunk=1000, dtype=numpy.float32, maximum_queued_steps=64):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.steps_per_chunk = steps_per_chunk
+        self.dtype = numpy.dtype(dtype).newbyteorder('<')
+        self.index = {'version': 1, 'dtype': self.dtype.str, 'steps': 0, 'chunks': []}
+        self.world = None
+        self.recorded_steps = 0
+
+        self.chunk = None
+        self.step_queue = queue.Queue(maximum_queued_steps)
+        self.writer_thread = threading.Thread(target=self.write_steps)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def attach(self, world):
+        self.world = world
+        world.add_step_listener(self.record_step)
+
+    def detach(self):
+        if self.world is not None:
+            self.world.remove_step_listener(self.record_step)
+            self.world = None
+
+    def record_step(self, world):
+        arrays = world.space_object_arrays
+        number_of_objects = arrays.number_of_objects
+        first_identifiers, second_identifiers = world.collision_detector_and_resolver.last_contacts
+        self.step_queue.put((self.recorded_steps, world.simulated_time,
+                             arrays.identifiers[:number_of_objects].copy(),
+                             arrays.positions[:number_of_objects].astype(self.dtype),
+                             arrays.velocities[:number_of_objects].astype(self.dtype),
+                             numpy.column_stack([numpy.full(len(first_identifiers), self.recorded_steps, dtype=numpy.int64),
+                                                 first_identifiers, second_identifiers])))
+        self.recorded_steps += 1
+
+    def close(self):
+        # Stops recording, waits for everything queued to be written, and finishes the last chunk.
+        self.detach()
+        self.step_queue.put(None)
+        self.writer_thread.join()
+
+    def write_steps(self):
+        while True:
+            step_state = self.step_queue.get()
+            if step_state is None:
+                self.finish_chunk()
+                return
+
+            step, time, identifiers, positions, velocities, contacts = step_state
+            rows = len(identifiers)
+            if self.chunk is not None and (self.chunk['steps'] == self.steps_per_chunk or
+                                           self.chunk['rows'] + rows > self.chunk['row_capacity']):
+                self.finish_chunk()
+            if self.chunk is None:
+                self.start_chunk(step, rows)
+
+            chunk = self.chunk
+            chunk_rows = slice(chunk['rows'], chunk['rows'] + rows)
+            chunk['positions'][chunk_rows] = positions
+            chunk['velocities'][chunk_rows] = velocities
+            chunk['identifiers'][chunk_rows] = identifiers
+            chunk['rows'] += rows
+            chunk['steps'] += 1
+            chunk['step_rows'].append(chunk['rows'])
+            chunk['times'].append(time)
+            chunk['contacts'].append(contacts)
+
+    def start_chunk(self, first_step, rows_in_first_step):
+        # Room is made for steps_per_chunk steps of as many objects as the first step has, plus a quarter more in case
+        # objects are added. A step that doesn't fit starts the next chunk early.
+        chunk_name = 'chunk_%06d' % len(self.index['chunks'])
+        row_capacity = max(1, int(self.steps_per_chunk * rows_in_first_step * 1.25))
+        self.chunk = {'name': chunk_name, 'first_step': first_step, 'steps': 0, 'rows': 0, 'row_capacity': row_capacity,
+                      'step_rows': [0], 'times': [], 'contacts': []}
+        for array_name, dtype, shape in (('positions', self.dtype, (row_capacity, 3)),
+                                         ('velocities', self.dtype, (row_capacity, 3)),
+                                         ('identifiers', numpy.dtype('<i8'), (row_capacity,))):
+            self.chunk[array_name] = numpy.memmap(chunk_path(self.directory, chunk_name, array_name), dtype=dtype,
+                                                  mode='w+', shape=shape)
+
+    def finish_chunk(self):
+        chunk = self.chunk
+        if chunk is None:
+            return
+
+        # The unused end of each file is cut off so the recording stays compact.
+        for array_name in ('positions', 'velocities', 'identifiers'):
+            chunk[array_name].flush()
+            used_bytes = chunk['rows'] * chunk[array_name].itemsize * (3 if array_name != 'identifiers' else 1)
+            del chunk[array_name]
+            with open(chunk_path(self.directory, chunk['name'], array_name), 'r+b') as chunk_file:
+                chunk_file.truncate(used_bytes)
+
+        numpy.array(chunk['step_rows'], dtype='<i8').tofile(chunk_path(self.directory, chunk['name'], 'step_rows'))
+        numpy.array(chunk['times'], dtype='<f8').tofile(chunk_path(self.directory, chunk['name'], 'times'))
+        contacts = numpy.concatenate(chunk['contacts']) if chunk['contacts'] else numpy.zeros((0, 3), dtype=numpy.int64)
+        contacts.astype('<i8').tofile(chunk_path(self.directory, chunk['name'], 'contacts'))
+
+        self.index['chunks'].append({'name': chunk['name'], 'first_step': chunk['first_step'], 'steps': chunk['steps'],
+                                     'rows': chunk['rows'], 'contacts': len(contacts)})
+        self.index['steps'] = chunk['first_step'] + chunk['steps']
+        write_index(self.directory, self.index)
+        self.chunk = None
+
+
+class TrajectoryReader:
+    # Reads a recording back without loading it: chunks are memory-mapped when a step in them is first asked for,
+    # and read_step() hands back views into them.
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json')) as index_file:
+            self.index = json.load(index_file)
+        self.dtype = numpy.dtype(str(self.index['dtype']))
+        self.chunks = self.index['chunks']
+        self.chunk_first_steps = [chunk['first_step'] for chunk in self.chunks]
+        self.number_of_steps = self.index['steps']
+        self.open_chunk_number = None
+        self.open_chunk = None
+
+    def __len__(self):
+        return self.number_of_steps
+
+    def load_chunk(self, chunk_number):
+        if chunk_number != self.open_chunk_number:
+            chunk = self.chunks[chunk_number]
+            name = chunk['name']
+            rows = chunk['rows']
+
+            def memory_map(array_name, dtype, shape):
+                if not shape[0]:
+                    return numpy.zeros(shape, dtype=dtype)
+                return numpy.memmap(chunk_path(self.directory, name, array_name), dtype=dtype, mode='r', shape=shape)
+
+            self.open_chunk = {'positions': memory_map('positions', self.dtype, (rows, 3)),
+                               'velocities': memory_map('velocities', self.dtype, (rows, 3)),
+                               'identifiers': memory_map('identifiers', numpy.dtype('<i8'), (rows,)),
+                               'step_rows': numpy.fromfile(chunk_path(self.directory, name, 'step_rows'), dtype='<i8'),
+                               'times': numpy.fromfile(chunk_path(self.directory, name, 'times'), dtype='<f8')}
+            self.open_chunk_number = chunk_number
+        return self.open_chunk
+
+    def read_step(self, step):
+        # The state of every object at the end of the given step:
+        #   {'step', 'time', 'identifiers', 'positions', 'velocities'}
+        if step < 0:
+            step += self.number_of_steps
+        if not 0 <= step < self.number_of_steps:
+            raise IndexError('step %d is not in a recording of %d steps' % (step, self.number_of_steps))
+
+        chunk_number = bisect.bisect_right(self.chunk_first_steps, step) - 1
+        chunk = self.load_chunk(chunk_number)
+        step_in_chunk = step - self.chunk_first_steps[chunk_number]
+        rows = slice(chunk['step_rows'][step_in_chunk], chunk['step_rows'][step_in_chunk + 1])
+        return {'step': step,
+                'time': float(chunk['times'][step_in_chunk]),
+                'identifiers': chunk['identifiers'][rows],
+                'positions': chunk['positions'][rows],
+                'velocities': chunk['velocities'][rows]}
+
+    def iterate_steps(self, start=0, stop=None, every=1):
+        # Yields read_step() for the steps from start up to stop, one at a time.
+        if stop is None or stop > self.number_of_steps:
+            stop = self.number_of_steps
+        for step in xrange(start, stop, every):
+            yield self.read_step(step)
+
+    def read_contacts(self, start=0, stop=None):
+        # Every contact resolved from step start up to stop, as rows of (step, identifier, identifier).
+        if stop is None:
+            stop = self.number_of_steps
+        contacts = [numpy.zeros((0, 3), dtype=numpy.int64)]
+        for chunk in self.chunks:
+            if chunk['first_step'] + chunk['steps'] <= start or chunk['first_step'] >= stop or not chunk['contacts']:
+                continue
+            chunk_contacts = numpy.fromfile(chunk_path(self.directory, chunk['name'], 'contacts'),
+                                            dtype='<i8').reshape(-1, 3)
+            contacts.append(chunk_contacts[(chunk_contacts[:, 0] >= start) & (chunk_contacts[:, 0] < stop)])
+        return numpy.concatenate(contacts)